@@ -31,6 +31,9 @@ class FlyArgs(object):
                     "and given learning algorithm trained on the given "\
                     "iteration."
         exec_help = 'Execution mode executes a given policy and collects data.'
+        extract_help = "Extract mode extracts the features of every recorded "\
+                       "trajectory of the given iterations from the saved "\
+                       "frames, resuming where an earlier run stopped."
         ann_help = "Annotate mode allows the user to specify the "\
                    "expert's policy at each iteration and trajectory of "\
                    "learning."
@@ -43,12 +46,38 @@ class FlyArgs(object):
         iterations_help = 'The total number of iterations to include in '\
                           'learning.'
         iteration_help = 'The current iteration of learning.'
+        processes_help = 'The number of processes extracting trajectories in '\
+                         'parallel. Default is the number of CPUs.'
+        cache_help = 'The directory of the feature cache. Default is '\
+                     '../data/cache.'
+        no_cache_help = 'Use this flag to extract without the feature cache.'
         trajectory_help = 'The current trajectory that will be learned.'
 
         help_help = 'Show this help message and exit.'
         gui_help = "Use this flag if you want to use the GUI to view the "\
                    "drone's camera. Default is to not launch the GUI."
         verbosity_help = 'Increase the output verbosity.'
+        flow_help = "The optical flow extractor. Use 'frame' for the dense "\
+                    "flow of the whole frame, 'sparse' for tracking corners "\
+                    "with Lucas-Kanade or 'window' for the dense flow of each "\
+                    "window. Default is 'frame'."
+        flow_tier_help = "The quality tier of the dense flow of the whole "\
+                         "frame, either 'ultrafast', 'fast' or 'accurate'. "\
+                         "Default is to solve the flow from scratch with the "\
+                         "original parameters."
+        dtype_help = "The precision of the features and of the model's "\
+                     "predictions, either 'float64' or 'float32', which "\
+                     "halves the size of the saved features. Default is "\
+                     "'float64'."
+        windows_help = "The windows the visual features are extracted over, "\
+                       "either 'uniform' for the 10x5 grid, 'foveated' for a "\
+                       "grid that is finer in the middle and leaves out the "\
+                       "sky, or a JSON file holding a window spec (see "\
+                       "feature_extraction/windows.py). Default is 'uniform'."
+        structure_help = "The structure features of each window, either "\
+                         "'hough' for the longest Hough line or 'orientation' "\
+                         "for a histogram of gradient orientations. Default "\
+                         "is 'hough'."
 
         # Argparser.
         self.arg_parser = argparse.ArgumentParser(prog=name, description=desc, epilog=epil, add_help=False)
@@ -56,11 +85,16 @@ class FlyArgs(object):
         optional_args.add_argument('-h', '--help', action='help', help=help_help)
         optional_args.add_argument('-g', '--gui', action='store_true', default=False, help=gui_help)
         optional_args.add_argument('-v', '--verbosity', action='count', default=0, help=verbosity_help)
+        optional_args.add_argument('-f', '--flow', type=str, default='frame', choices=['frame', 'sparse', 'window'], help=flow_help)
+        optional_args.add_argument('-t', '--flow-tier', type=str, default=None, choices=['ultrafast', 'fast', 'accurate'], help=flow_tier_help)
+        optional_args.add_argument('-d', '--dtype', type=str, default='float64', choices=['float64', 'float32'], help=dtype_help)
+        optional_args.add_argument('-w', '--windows', type=str, default='uniform', help=windows_help)
+        optional_args.add_argument('-s', '--structure', type=str, default='hough', choices=['hough', 'orientation'], help=structure_help)
 
 
         # Subparser.
         sub_title = 'Subcommands'
-        sub_desc = "Valid subcommands are either 'train', 'test', 'exec' or 'annotate'."
+        sub_desc = "Valid subcommands are either 'train', 'test', 'exec', 'extract' or 'annotate'."
         subparsers = self.arg_parser.add_subparsers(title=sub_title,
                                                     description=sub_desc,
                                                     dest='command', help='')
@@ -101,6 +135,16 @@ class FlyArgs(object):
         ann_pos_args.add_argument('iteration', type=int, help=iteration_help)
         ann_pos_args.add_argument('trajectory', type=int, help=trajectory_help)
 
+        extract_parser = subparsers.add_parser('extract', help=extract_help, add_help=False)
+        extract_opt_args = extract_parser.add_argument_group('Optional arguments', '')
+        extract_opt_args.add_argument('-h', '--help', action='help', help=help_help)
+        extract_opt_args.add_argument('-p', '--processes', type=int, default=0, help=processes_help)
+        extract_opt_args.add_argument('-c', '--cache', type=str, default='../data/cache', help=cache_help)
+        extract_opt_args.add_argument('--no-cache', action='store_true', default=False, help=no_cache_help)
+
+        extract_pos_args = extract_parser.add_argument_group('Extraction arguments', '')
+        extract_pos_args.add_argument('iterations', type=int, help=iterations_help)
+
         run_parser = subparsers.add_parser('run', help='run with no arguments', add_help=False)
         
     def parse(self):
@@ -118,6 +162,9 @@ class FlyArgs(object):
         elif self.args.command == 'annotate':
             self._parse_iteration()
             self._parse_trajectory()
+        elif self.args.command == 'extract':
+            self._parse_iterations()
+            self._parse_processes()
 
 
     def _parse_address(self, i):
@@ -157,6 +204,16 @@ class FlyArgs(object):
         if iteration <= 0:
             raise debug.Error('args', 'iteration %s is not a positive integer' % iteration)
 
+    def _parse_iterations(self):
+        iterations = self.args.iterations
+        if iterations <= 0:
+            raise debug.Error('args', 'iterations %s is not a positive integer' % iterations)
+
+    def _parse_processes(self):
+        processes = self.args.processes
+        if processes < 0:
+            raise debug.Error('args', 'processes %s is not a non-negative integer' % processes)
+
     def _parse_trajectory(self):
         trajectory = self.args.trajectory
         if trajectory <= 0:
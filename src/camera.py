@@ -3,36 +3,267 @@
 """ Camera module.
 """
 
+import ctypes
+import ctypes.util
 import cv2
 import debug
 import math
 import threading
+import time
 import Queue
 
 
+class _Timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+# Python 2 has no monotonic clock, so read the system's through ctypes where
+# there is one (CLOCK_MONOTONIC is 1 on Linux).
+try:
+    _clock_gettime = ctypes.CDLL(ctypes.util.find_library('rt') or 'libc.so.6', use_errno=True).clock_gettime
+    _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+except (OSError, AttributeError):
+    _clock_gettime = None
+
+
+def monotonic():
+    """ Returns the time in seconds of a clock that is not set back or
+        forward with the wall clock, falling back on the wall clock where
+        there is no such clock.
+    """
+    if _clock_gettime is None:
+        return time.time()
+    t = _Timespec()
+    if _clock_gettime(1, ctypes.byref(t)) != 0:
+        return time.time()
+    return t.tv_sec + t.tv_nsec*1e-9
+
+
+class FrameBuffer(object):
+    """ A reusable image buffer of a frame pool with a reference count.
+
+        Whoever holds a reference calls release when done with the image and
+        the buffer goes back to its pool once the last reference is released,
+        to have the next frame decoded into it. Buffers without a pool wrap an
+        ordinary image and releasing them does nothing.
+    """
+    def __init__(self, image=None, pool=None):
+        self.image = image
+        self.pool = pool
+        self.refs = 1
+
+    def retain(self):
+        """ Takes another reference to the buffer and returns it.
+        """
+        if self.pool is not None:
+            with self.pool.lock:
+                self.refs += 1
+        return self
+
+    def release(self):
+        """ Releases a reference to the buffer.
+        """
+        if self.pool is not None:
+            self.pool.put_back(self)
+
+    def detach(self):
+        """ Takes the buffer out of its pool so its image is never
+            overwritten, for images kept around for long.
+        """
+        if self.pool is not None:
+            self.pool.remove(self)
+
+
+class FramePool(object):
+    """ A pool of frame buffers the camera decodes frames into, so capturing
+        does not allocate a new image for every frame.
+
+        Buffers adopt the shape of the first frame decoded into them and are
+        reused from then on. The pool holds size buffers in steady state, one
+        for each frame in flight (being captured, in the mailbox, being
+        extracted and being recorded). When they are all held a new buffer is
+        allocated instead of blocking the camera, which is counted in grown.
+    """
+    def __init__(self, size=4):
+        self.size = size
+        self.lock = threading.Lock()
+        self.free = []
+
+        # Counters for measuring the pool.
+        self.allocated = 0
+        self.grown = 0
+
+    def acquire(self):
+        """ Returns a free buffer holding a single reference.
+        """
+        with self.lock:
+            if self.free:
+                frame_buffer = self.free.pop()
+            else:
+                if self.allocated >= self.size:
+                    self.grown += 1
+                self.allocated += 1
+                frame_buffer = FrameBuffer(pool=self)
+            frame_buffer.refs = 1
+            return frame_buffer
+
+    def put_back(self, frame_buffer):
+        with self.lock:
+            frame_buffer.refs -= 1
+            if frame_buffer.refs == 0 and frame_buffer.pool is self:
+                self.free.append(frame_buffer)
+
+    def remove(self, frame_buffer):
+        with self.lock:
+            if frame_buffer.pool is self:
+                frame_buffer.pool = None
+                self.allocated -= 1
+
+
+class FrameMailbox(object):
+    """ Holds the newest frame from a camera.
+
+        Putting a frame always replaces the one held, so the consumer gets
+        the newest frame instead of the oldest one buffered. Each frame
+        carries the monotonic time it was captured at (see monotonic) and
+        its sequence number. Frames replaced before being read are counted
+        in dropped, and frames read too late to be used in stale.
+
+        A frame can be put along with the frame buffer holding it (see
+        FramePool). The mailbox owns the reference to the buffer until the
+        frame is read and passes it on to the reader, who releases it, while
+        buffers of frames dropped or rejected as stale are released right
+        away.
+
+        Cameras that can skip decoding frames ask wants_frame whether the
+        next frame is worth decoding, which is when a reader is waiting in
+        get for a frame not yet put. The number of such readers is kept in
+        waiting.
+    """
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.frame = None
+        self.waiting = 0
+
+        # Counters for measuring the mailbox.
+        self.seq = 0
+        self.read_seq = 0
+        self.dropped = 0
+        self.stale = 0
+
+    def put(self, image, timestamp=None, frame_buffer=None):
+        """ Replaces the frame held with the image captured at the given
+            monotonic time (now if not given), held in the given frame buffer
+            if any.
+        """
+        timestamp = monotonic() if timestamp is None else timestamp
+        frame_buffer = FrameBuffer(image) if frame_buffer is None else frame_buffer
+        with self.condition:
+            if self.seq > self.read_seq:
+                self.dropped += 1
+                self.frame['BUFFER'].release()
+            self.seq += 1
+            self.frame = {'IMAGE': image, 'SEQ': self.seq, 'TIMESTAMP': timestamp, 'BUFFER': frame_buffer}
+            self.condition.notify_all()
+
+    def get(self, block=True, timeout=None, max_age=None):
+        """ Returns the newest frame not yet read, as a dictionary holding the
+            image (IMAGE), its sequence number (SEQ), capture time
+            (TIMESTAMP), age in seconds (AGE) and the frame buffer holding it
+            (BUFFER), which the caller has to release. If block is set, waits at
+            most timeout seconds (forever if timeout is None) for a frame.
+            Frames older than max_age seconds are rejected and waited past.
+            Returns None if there is no such frame in time.
+        """
+        with self.condition:
+            deadline = None if timeout is None else monotonic() + timeout
+            while True:
+                if self.seq > self.read_seq:
+                    self.read_seq = self.seq
+                    age = monotonic() - self.frame['TIMESTAMP']
+                    if max_age is None or age <= max_age:
+                        frame = dict(self.frame)
+                        frame['AGE'] = age
+                        return frame
+                    self.stale += 1
+                    self.frame['BUFFER'].release()
+                remaining = None if deadline is None else deadline - monotonic()
+                if not block or (remaining is not None and remaining <= 0):
+                    return None
+                self.waiting += 1
+                try:
+                    self.condition.wait(remaining)
+                finally:
+                    self.waiting -= 1
+
+    def wants_frame(self):
+        """ Returns whether a reader is waiting for a new frame. Readers
+            that were just handed a frame and have not woken up yet do not
+            count.
+        """
+        with self.condition:
+            return self.waiting > 0 and self.seq == self.read_seq
+
+
 class Camera(threading.Thread):
     """ Encapsulates the camera on the AR Parrot Drone 2.0. Handles the
-        receiving of images from the drone using OpenCV.
+        receiving of images from the drone using OpenCV. Every frame is
+        grabbed from the stream, stamped with the time it was grabbed,
+        decoded into a buffer of the frame pool and put into the mailbox.
+
+        In 'read' mode every frame is decoded. In 'grab' mode the stream is
+        still grabbed frame by frame to keep it drained, but a frame is only
+        decoded (retrieved) when a reader is waiting for one (see
+        FrameMailbox.wants_frame), so frames no one reads are never
+        converted to images. A reader gets the first frame grabbed after it
+        started waiting, so frames are at most one camera period older than
+        in 'read' mode while reading waits up to one camera period longer.
+        Readers that do not block never get a frame in this mode. Frames
+        only grabbed are counted in grabbed_only and frames decoded in
+        decoded.
     """
-    def __init__(self, debug_queue, error_queue, address, queue):
+    MODES = ('read', 'grab')
+
+    def __init__(self, debug_queue, error_queue, address, mailbox, pool=None, mode='read'):
         threading.Thread.__init__(self)
+        if mode not in self.MODES:
+            raise ValueError("capture mode %s is not 'read' or 'grab'" % mode)
         self.debug_queue = debug_queue
         self.error_queue = error_queue
         self.address = address
-        self.queue = queue
+        self.mailbox = mailbox
+        self.pool = FramePool() if pool is None else pool
+        self.mode = mode
+
+        # Counters for measuring the camera.
+        self.grabbed_only = 0
+        self.decoded = 0
 
     def run(self):
         cap = self.get_cap()
         while cap.isOpened():
-            (ret, frame) = cap.read()
+            if not cap.grab():
+                cap.release()
+                break
+            timestamp = monotonic()
+            if self.mode == 'grab' and not self.mailbox.wants_frame():
+                self.grabbed_only += 1
+                continue
+
+            # Decode in place into a free buffer once it has the frame shape.
+            frame_buffer = self.pool.acquire()
+            if frame_buffer.image is None:
+                (ret, frame) = cap.retrieve()
+            else:
+                (ret, frame) = cap.retrieve(frame_buffer.image)
             # If the image needs to converted to PIL, uncomment this line.
             # frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
             if ret:
-                try:
-                    self.queue.put(frame, block=False)
-                except Queue.Full:
-                    pass
+                frame_buffer.image = frame
+                self.decoded += 1
+                self.mailbox.put(frame, timestamp, frame_buffer)
             else:
+                frame_buffer.release()
                 cap.release()
 
     def get_cap(self):
@@ -45,6 +276,9 @@ def _test_camera():
     pdb.set_trace()
 
     # Conduct tests...
+    _test_frame_mailbox()
+    _test_frame_pool()
+    _test_grab_mode()
     _test_get_image()
     #_test_get_windows(show_window=False)
 
@@ -57,9 +291,9 @@ def _test_get_image():
     debugger = debug.Debug(verbosity, debug_queue, error_queue)
 
     # Make sure the images look right.
-    image_queue = Queue.Queue(maxsize=1)
+    mailbox = FrameMailbox()
     camera_address = 'tcp://192.168.1.1:5555'
-    camera = Camera(debug_queue, error_queue, camera_address, image_queue)
+    camera = Camera(debug_queue, error_queue, camera_address, mailbox)
     camera.daemon = True
     camera.start()
 
@@ -67,7 +301,7 @@ def _test_get_image():
         i = 0
         while True:
             debugger.debug()
-            image = image_queue.get(block=True)
+            image = mailbox.get()['IMAGE']
             cv2.imshow('image', image)
             key = cv2.waitKey(1) & 0xff
             if key == ord('q'):
@@ -82,6 +316,108 @@ def _test_get_image():
         sys.exit(0)
 
 
+def _test_frame_mailbox():
+    # Make sure the newest frame is read and the others are counted.
+    mailbox = FrameMailbox()
+    assert mailbox.get(block=False) is None
+    mailbox.put('frame1')
+    mailbox.put('frame2')
+    frame = mailbox.get(timeout=0.1)
+    assert frame['IMAGE'] == 'frame2' and frame['SEQ'] == 2 and frame['AGE'] >= 0
+    assert mailbox.dropped == 1 and mailbox.get(timeout=0.01) is None
+
+    # Stale frames are rejected.
+    mailbox.put('frame3', monotonic() - 1.0)
+    assert mailbox.get(timeout=0.01, max_age=0.5) is None and mailbox.stale == 1
+    threading.Timer(0.05, mailbox.put, ['frame4']).start()
+    assert mailbox.get(timeout=1.0, max_age=0.5)['IMAGE'] == 'frame4'
+    assert monotonic() <= monotonic()
+    print('Success.')
+
+
+def _test_frame_pool():
+    # Make sure buffers are reused once every reference is released.
+    pool = FramePool(size=2)
+    first = pool.acquire()
+    second = pool.acquire().retain()
+    second.release()
+    assert pool.acquire() is not second and pool.grown == 1
+    second.release()
+    first.release()
+    assert pool.acquire() in (first, second)
+
+    # Frames dropped from the mailbox give their buffers back.
+    pool = FramePool(size=2)
+    mailbox = FrameMailbox()
+    mailbox.put('frame1', frame_buffer=pool.acquire())
+    mailbox.put('frame2', frame_buffer=pool.acquire())
+    frame = mailbox.get(timeout=0.1)
+    assert frame['IMAGE'] == 'frame2' and len(pool.free) == 1
+    frame['BUFFER'].release()
+    assert len(pool.free) == 2 and pool.allocated == 2
+
+    # Detached buffers are never reused.
+    detached = pool.acquire()
+    detached.detach()
+    detached.release()
+    assert detached not in pool.free and pool.allocated == 1
+
+    # Make sure the camera decodes frames in place once the pool is warm.
+    class FileCamera(Camera):
+        def get_cap(self):
+            return cv2.VideoCapture('../samples/test_cat.mp4')
+
+    pool = FramePool()
+    mailbox = FrameMailbox()
+    camera = FileCamera(None, None, None, mailbox, pool)
+    camera.daemon = True
+    camera.start()
+    images = set()
+    frame = mailbox.get(timeout=5.0)
+    while frame is not None:
+        images.add(frame['IMAGE'].ctypes.data)
+        frame['BUFFER'].release()
+        frame = mailbox.get(timeout=1.0)
+    camera.join()
+    assert pool.grown == 0 and len(images) <= pool.size
+    print('Success.')
+
+
+def _test_grab_mode():
+    # Make sure a slow consumer only has the frames it reads decoded.
+    class FileCamera(Camera):
+        def get_cap(self):
+            return cv2.VideoCapture('../samples/test_cat.mp4')
+
+    frames = {}
+    for mode in Camera.MODES:
+        mailbox = FrameMailbox()
+        camera = FileCamera(None, None, None, mailbox, mode=mode)
+        camera.daemon = True
+        camera.start()
+        read = 0
+        fresh = 0
+        requested = monotonic()
+        frame = mailbox.get(timeout=5.0)
+        while frame is not None:
+            read += 1
+            fresh += frame['TIMESTAMP'] >= requested
+            frame['BUFFER'].release()
+            time.sleep(0.02)
+            requested = monotonic()
+            frame = mailbox.get(timeout=1.0)
+        camera.join()
+        frames[mode] = camera.grabbed_only + camera.decoded
+        if mode == 'read':
+            assert camera.grabbed_only == 0
+        else:
+            # Every frame read was grabbed after it was asked for.
+            assert camera.grabbed_only > 0 and camera.decoded <= read + 1
+            assert fresh == read and mailbox.dropped == 0
+    assert frames['read'] == frames['grab']
+    print('Success.')
+
+
 def _test_get_windows(show_window=False):
     # Make sure the resulting windows look right.
     test_image_filename = './../samples/test_forest.jpg'
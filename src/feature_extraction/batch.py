@@ -0,0 +1,229 @@
+#!/usr/bin/env python2.7
+
+""" Offline extraction of the features of recorded trajectories.
+"""
+
+import itertools
+import json
+import multiprocessing
+import os
+import threading
+import traceback
+import Queue
+import cv2
+import numpy as np
+
+import cache
+import feature_extractor
+import layout
+
+
+class FrameReader(threading.Thread):
+    """ Reads and decodes the frames of a trajectory ahead of the extractor.
+
+        The frames <directory>/<time step>.jpg are decoded in order, starting
+        at time step 1 and stopping at the first missing one, into a bounded
+        queue so decoding overlaps with extraction (OpenCV releases the GIL
+        while decoding). Iterating over the reader yields the time step and
+        frame of each one in order.
+    """
+    def __init__(self, directory, prefetch=8):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.directory = directory
+        self.queue = Queue.Queue(maxsize=prefetch)
+
+    def run(self):
+        time_step = 1
+        while True:
+            image = cv2.imread(os.path.join(self.directory, '%s.jpg' % time_step))
+            if image is None:
+                break
+            self.queue.put((time_step, image))
+            time_step += 1
+        self.queue.put(None)
+
+    def __iter__(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            yield item
+
+
+def get_trajectories(data_directory, iterations):
+    """ Returns the directory of every recorded trajectory of the given
+        number of iterations, numbered from 1 like DAgger.aggregate expects.
+    """
+    trajectories = []
+    for i in range(1, iterations + 1):
+        t = 1
+        while os.path.isfile(os.path.join(data_directory, str(i), str(t), '1.jpg')):
+            trajectories.append(os.path.join(data_directory, str(i), str(t)))
+            t += 1
+    return trajectories
+
+
+def get_config_hash(extractor, params):
+    """ Hashes everything the features written by the extractor depend on.
+    """
+    return cache.hash_config({
+        'PARAMS': params,
+        'LAYOUT': extractor.layout.blocks,
+        'BLOCKS': extractor.config_hashes
+    })
+
+
+def load_nav_history(directory, feature_layout):
+    """ Returns the navigation history features recorded while flying the
+        trajectory by time step, read from the features.data file fly.py
+        wrote, or none if there is no such file. Raises a ValueError if the
+        navigation history columns cannot be found in it, so the recorded
+        features are never replaced without them.
+    """
+    features_filename = os.path.join(directory, 'features.data')
+    if not os.path.isfile(features_filename):
+        return {}
+    rows = np.loadtxt(features_filename, ndmin=2)
+
+    # Features recorded before layouts were saved have the current layout.
+    layout_filename = os.path.join(directory, 'features.layout')
+    if os.path.isfile(layout_filename):
+        recorded = layout.FeatureLayout.load(layout_filename)
+    else:
+        recorded = feature_layout
+    if rows.shape[1] != recorded.size + 1:
+        raise ValueError('%s has %s columns but its layout has %s' % (features_filename, rows.shape[1], recorded.size + 1))
+    if recorded.get_block('nav_history') != feature_layout.get_block('nav_history'):
+        raise ValueError('navigation history recorded in %s does not match the extractor' % features_filename)
+    columns = recorded.slices['nav_history']
+    return dict((int(row[0]), row[1:][columns]) for row in rows)
+
+
+def extract_trajectory(task):
+    """ Extracts the features of every frame of a trajectory in order and
+        writes them to its features.data file along with its layout. Runs in
+        the batch processes.
+
+        The command history is rebuilt from the commands recorded in
+        drone_cmds.data, where the features of each time step only include
+        the commands sent before it. Navigation data is only recorded as the
+        navigation history features of the features.data file written while
+        flying, so those are copied over by time step. Time steps without
+        recorded features get a zero navigation history.
+    """
+    (directory, params, cache_directory) = task
+    extractor = None
+    try:
+        try:
+            with open(os.path.join(directory, 'drone_cmds.data')) as f:
+                cmds = [json.loads(line) for line in f if line.strip()]
+        except IOError:
+            cmds = []
+
+        reader = FrameReader(directory)
+        reader.start()
+        frames = iter(reader)
+        (_, init_image) = next(frames)
+
+        feature_cache = cache.FeatureCache(cache_directory) if cache_directory else None
+        extractor = feature_extractor.FeatureExtractor(init_image, cache=feature_cache, **params)
+        nav = np.zeros(len(extractor.extractor_nav_history.FEATURES))
+        nav_history = load_nav_history(directory, extractor.layout)
+        nav_columns = extractor.layout.slices['nav_history']
+
+        # Write to a temporary file so an interrupted trajectory is redone.
+        features_filename = os.path.join(directory, 'features.data')
+        temp_filename = features_filename + '.tmp'
+        with open(temp_filename, 'w') as out:
+            for (time_step, image) in itertools.chain([(1, init_image)], frames):
+                features = extractor.get_features(image)
+                if time_step in nav_history:
+                    features[0, nav_columns] = nav_history[time_step]
+                np.savetxt(out, np.hstack(([[time_step]], features)), fmt=extractor.layout.get_format())
+                if time_step <= len(cmds):
+                    extractor.extractor_cmd_history.update(cmds[time_step - 1])
+                extractor.extractor_nav_history.update(nav, form=True)
+        os.rename(temp_filename, features_filename)
+        extractor.layout.save(os.path.join(directory, 'features.layout'))
+    except Exception:
+        return (directory, None, traceback.format_exc())
+    finally:
+        if extractor is not None:
+            extractor.stop()
+    return (directory, time_step, None)
+
+
+class BatchExtractor(object):
+    """ Extracts the features of every recorded trajectory of the first
+        iterations in a pool of processes.
+
+        Trajectories are independent, so each process extracts whole
+        trajectories, while the frames of a trajectory are extracted in order
+        since the optical flow and the history depend on the frames before
+        them. The extractor parameters are the keyword arguments of
+        FeatureExtractor besides the initial image.
+
+        Finished trajectories are recorded in a manifest along with the hash
+        of the extractor configuration, so an interrupted run only redoes the
+        unfinished trajectories when run again, while changing the
+        configuration redoes all of them. Trajectories are the unit of
+        resumption because the state of the extractors cannot be restored in
+        the middle of one. A feature cache shared by the processes can be
+        given to only recompute the blocks whose configuration changed.
+    """
+    def __init__(self, data_directory, iterations, params, processes=None, cache_directory=None):
+        self.data_directory = data_directory
+        self.iterations = iterations
+        self.params = params
+        self.processes = processes or multiprocessing.cpu_count()
+        self.cache_directory = cache_directory
+        self.manifest_filename = os.path.join(data_directory, 'extract_manifest.json')
+
+    def load_manifest(self):
+        try:
+            with open(self.manifest_filename) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def save_manifest(self, manifest):
+        temp_filename = self.manifest_filename + '.tmp'
+        with open(temp_filename, 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.rename(temp_filename, self.manifest_filename)
+
+    def run(self, callback=None):
+        """ Extracts every unfinished trajectory, calling callback with the
+            directory, number of frames and error (None on success) of each
+            as they finish. Returns the directories that failed.
+        """
+        trajectories = get_trajectories(self.data_directory, self.iterations)
+        if not trajectories:
+            return []
+
+        # Hash the configuration using an extractor on the first frame.
+        init_image = cv2.imread(os.path.join(trajectories[0], '1.jpg'))
+        extractor = feature_extractor.FeatureExtractor(init_image, **self.params)
+        config_hash = get_config_hash(extractor, self.params)
+        extractor.stop()
+
+        manifest = self.load_manifest()
+        todo = [d for d in trajectories if manifest.get(d, {}).get('CONFIG') != config_hash]
+        tasks = [(d, self.params, self.cache_directory) for d in todo]
+
+        failed = []
+        pool = multiprocessing.Pool(self.processes)
+        try:
+            for (directory, frames, error) in pool.imap_unordered(extract_trajectory, tasks):
+                if error is None:
+                    manifest[directory] = {'CONFIG': config_hash, 'FRAMES': frames}
+                    self.save_manifest(manifest)
+                else:
+                    failed.append(directory)
+                if callback is not None:
+                    callback(directory, frames, error)
+        finally:
+            pool.close()
+            pool.join()
+        return failed
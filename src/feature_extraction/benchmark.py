@@ -0,0 +1,173 @@
+#!/usr/bin/env python2.7
+
+""" Benchmarks alternative feature extractors on recorded trajectories.
+"""
+
+import itertools
+import json
+import os
+import sys
+import time
+import numpy as np
+
+import batch
+import feature_extractor
+
+
+# The feature extraction parameters used when flying.
+PARAMS = {
+    'window_size': (10, 5),
+    'overlap': 0.25,
+    'cmd_history_feats': 7,
+    'cmd_history_length': 10,
+    'nav_history_feats': 7,
+    'nav_history_length': 10
+}
+
+
+# The ridge penalty DAgger trains with.
+ALPHA = 0.5
+
+
+def load_cmds(directory, name):
+    """ Returns the commands recorded in a trajectory's <name>.data file, or
+        none if it was not recorded.
+    """
+    try:
+        with open(os.path.join(directory, '%s.data' % name)) as f:
+            return [json.loads(line) for line in f if line.strip()]
+    except IOError:
+        return []
+
+
+def run_extractor(directory, params):
+    """ Extracts the features of every frame of a recorded trajectory in
+        order. Returns the features with one row per frame and the time
+        taken to extract the visual features of each frame.
+    """
+    cmds = load_cmds(directory, 'drone_cmds')
+
+    reader = batch.FrameReader(directory)
+    reader.start()
+    frames = iter(reader)
+    (_, init_image) = next(frames)
+    extractor = feature_extractor.FeatureExtractor(init_image, **params)
+    nav = np.zeros(len(extractor.extractor_nav_history.FEATURES))
+    features = []
+    latencies = []
+    try:
+        for (time_step, image) in itertools.chain([(1, init_image)], frames):
+            feats = extractor.layout.get_buffer()
+            start_time = time.time()
+            extractor.get_visual_features(image, feats)
+            latencies.append(time.time() - start_time)
+            features.append(extractor.get_nav_features(feats))
+            if time_step <= len(cmds):
+                extractor.extractor_cmd_history.update(cmds[time_step - 1])
+            extractor.extractor_nav_history.update(nav, form=True)
+    finally:
+        extractor.stop()
+    return (np.vstack(features), np.array(latencies))
+
+
+def get_fit_error(features, targets, alpha=ALPHA):
+    """ Returns the errors of a ridge regressor predicting the targets of
+        each trajectory from its features after being trained on the other
+        trajectories, given one array of features and targets per
+        trajectory.
+    """
+    errors = []
+    for i in range(0, len(features)):
+        x = np.vstack(features[:i] + features[i + 1:])
+        y = np.concatenate(targets[:i] + targets[i + 1:])
+        (x_mean, y_mean) = (np.mean(x, 0), np.mean(y))
+        x = x - x_mean
+        weights = np.linalg.solve(np.dot(x.T, x) + alpha*np.eye(x.shape[1]), np.dot(x.T, y - y_mean))
+        errors.append(np.dot(features[i] - x_mean, weights) + y_mean - targets[i])
+    return np.concatenate(errors)
+
+
+def compare(directories, base_params, alt_params, coef=None):
+    """ Compares the latency of extracting the visual features with the
+        alternative parameters against the base parameters over the recorded
+        trajectories, leaving out the first frame of each. Given the weights of
+        a linear policy trained on features extracted with the base
+        parameters (with the time step column first, as saved by DAgger),
+        also compares the commands it predicts from either set of
+        features, as long as both have the same columns (not with other
+        windows for instance).
+
+        Features that do not share columns, such as the orientation
+        histograms and the Hough features, are compared by how well a ridge
+        regressor trained on each predicts the expert commands recorded in
+        the trajectories, leaving each trajectory out in turn (FIT_ERROR).
+        This needs at least two trajectories with expert commands.
+    """
+    results = {'BASE_LATENCY': [], 'ALT_LATENCY': [], 'POLICY_ERROR': []}
+    fits = {'BASE_FIT_ERROR': [], 'ALT_FIT_ERROR': [], 'TARGETS': []}
+    for directory in directories:
+        (base_features, base_latencies) = run_extractor(directory, base_params)
+        (alt_features, alt_latencies) = run_extractor(directory, alt_params)
+        expert_cmds = load_cmds(directory, 'expert_cmds')
+        if expert_cmds:
+            n = min(len(expert_cmds), base_features.shape[0])
+            fits['BASE_FIT_ERROR'].append(base_features[:n])
+            fits['ALT_FIT_ERROR'].append(alt_features[:n])
+            fits['TARGETS'].append(np.array([cmd['X'] for cmd in expert_cmds[:n]]))
+        results['BASE_LATENCY'].append(base_latencies[1:])
+        results['ALT_LATENCY'].append(alt_latencies[1:])
+        if coef is not None and alt_features.shape == base_features.shape:
+            weights = np.ravel(coef)[1:]
+            error = np.dot(alt_features, weights) - np.dot(base_features, weights)
+            results['POLICY_ERROR'].append(error)
+
+    summary = {}
+    for key in ('BASE_LATENCY', 'ALT_LATENCY'):
+        latencies = np.concatenate(results[key])
+        summary[key] = {'MEAN': np.mean(latencies), 'P95': np.percentile(latencies, 95)}
+    if results['POLICY_ERROR']:
+        error = np.concatenate(results['POLICY_ERROR'])
+        summary['POLICY_ERROR'] = {'RMS': np.sqrt(np.mean(error**2)), 'MAX': np.max(np.abs(error))}
+    if len(fits['TARGETS']) > 1:
+        for key in ('BASE_FIT_ERROR', 'ALT_FIT_ERROR'):
+            error = get_fit_error(fits[key], fits['TARGETS'])
+            summary[key] = {'RMS': np.sqrt(np.mean(error**2)), 'MAX': np.max(np.abs(error))}
+    return summary
+
+
+def main():
+    """ Benchmarks alternative extraction parameters against the ones used
+        when flying on every recorded trajectory of the given iterations:
+
+            benchmark.py <iterations> <data directory> <name>=<value> ...
+
+        For example 'benchmark.py 3 ../../data flow_mode=sparse' compares the
+        sparse flow against the dense flow and 'window_size=foveated' the
+        foveated windows against the uniform ones, while 'structure=orientation'
+        compares the orientation histograms against the Hough transform.
+        Values are parsed as JSON and taken as strings otherwise. The policy error is only reported if a
+        trained model is saved in the data directory.
+    """
+    iterations = int(sys.argv[1])
+    data_directory = sys.argv[2]
+    alt_params = dict(PARAMS)
+    for arg in sys.argv[3:]:
+        (name, value) = arg.split('=', 1)
+        try:
+            alt_params[name] = json.loads(value)
+        except ValueError:
+            alt_params[name] = value
+
+    directories = batch.get_trajectories(data_directory, iterations)
+    coef = None
+    if os.path.isfile(os.path.join(data_directory, 'coef.txt')):
+        coef = np.loadtxt(os.path.join(data_directory, 'coef.txt'), ndmin=2)
+
+    summary = compare(directories, PARAMS, alt_params, coef)
+    print('%s trajectories' % len(directories))
+    for key in sorted(summary):
+        print('%s: %s' % (key, ', '.join('%s %.4f' % (k, v) for (k, v) in sorted(summary[key].items()))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python2.7
+
+""" Persistent content-addressed cache of extracted feature blocks.
+"""
+
+import errno
+import hashlib
+import json
+import os
+import numpy as np
+
+
+def hash_config(config):
+    """ Hashes the configuration of an extractor, a dictionary of JSON
+        serializable values.
+    """
+    return hashlib.sha1(json.dumps(config, sort_keys=True)).hexdigest()
+
+
+class FeatureCache(object):
+    """ Caches the feature blocks of frames on disk.
+
+        Each entry holds the features of one block (one extractor) for one
+        frame, keyed by the hash of the frame's content, the name of the block
+        and the hash of the block's configuration (see hash_config). Entries
+        are stored as binary numpy files under
+        <directory>/<name>/<config hash>/<frame hash>.npy, so changing the
+        parameters of one extractor only misses the cache for that
+        extractor.
+
+        The cache is kept under max_size bytes by evicting the least recently
+        used entries, whose modification time is touched on every hit. When
+        the cache grows past max_size it is trimmed down to LOW_WATER of
+        max_size so eviction does not run on every new entry. Entries are
+        written to a temporary file first and renamed into place, so several
+        processes can share a cache.
+    """
+    # Fraction of max_size the cache is trimmed down to when it is full.
+    LOW_WATER = 0.9
+
+    def __init__(self, directory, max_size=256*2**20):
+        self.directory = directory
+        self.max_size = max_size
+
+        # Counters for measuring the cache.
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+        self.size = sum(size for (_, size, _) in self.get_entries())
+
+    def get_filename(self, name, config_hash, frame_hash):
+        return os.path.join(self.directory, name, config_hash, frame_hash + '.npy')
+
+    def get(self, name, config_hash, frame_hash):
+        """ Returns the cached features of the block for the frame, or None
+            if they are not in the cache.
+        """
+        filename = self.get_filename(name, config_hash, frame_hash)
+        try:
+            features = np.load(filename)
+            os.utime(filename, None)
+        except (IOError, OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return features
+
+    def put(self, name, config_hash, frame_hash, features):
+        """ Stores the features of the block for the frame.
+        """
+        filename = self.get_filename(name, config_hash, frame_hash)
+        try:
+            os.makedirs(os.path.dirname(filename))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        temp_filename = '%s.%s.tmp' % (filename, os.getpid())
+        with open(temp_filename, 'wb') as f:
+            np.save(f, features)
+        os.rename(temp_filename, filename)
+
+        self.size += os.path.getsize(filename)
+        if self.size > self.max_size:
+            self.evict()
+
+    def get_entries(self):
+        """ Returns the access time, size and filename of every entry.
+        """
+        entries = []
+        for (root, _, filenames) in os.walk(self.directory):
+            for filename in filenames:
+                if not filename.endswith('.npy'):
+                    continue
+                filename = os.path.join(root, filename)
+                try:
+                    stat = os.stat(filename)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, filename))
+        return entries
+
+    def evict(self):
+        """ Removes the least recently used entries until the cache is under
+            LOW_WATER of its maximum size.
+        """
+        entries = sorted(self.get_entries())
+        self.size = sum(size for (_, size, _) in entries)
+        for (_, size, filename) in entries:
+            if self.size <= self.LOW_WATER*self.max_size:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                continue
+            self.size -= size
+            self.evicted += 1
+
+
+def _test_feature_cache():
+    import shutil
+    import tempfile
+    directory = tempfile.mkdtemp()
+    try:
+        cache = FeatureCache(directory, max_size=10000)
+        config_hash = hash_config({'THRESH': 100})
+        assert config_hash != hash_config({'THRESH': 50})
+        assert cache.get('hough', config_hash, 'frame') is None
+
+        features = np.random.rand(50, 4)
+        cache.put('hough', config_hash, 'frame', features)
+        assert np.array_equal(cache.get('hough', config_hash, 'frame'), features)
+        assert cache.hits == 1 and cache.misses == 1
+
+        # Filling the cache evicts the oldest entries.
+        for i in range(0, 20):
+            cache.put('hough', config_hash, 'frame%s' % i, features)
+        assert cache.size <= cache.max_size and cache.evicted > 0
+        assert cache.get('hough', config_hash, 'frame19') is not None
+    finally:
+        shutil.rmtree(directory)
+    print('Success.')
+
+
+if __name__ == '__main__':
+    _test_feature_cache()
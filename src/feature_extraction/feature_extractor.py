@@ -3,107 +3,569 @@
 """ Feature extractor which extracts features in a thread.
 """
 
-import math
+import hashlib
 import threading
-import Queue
+import time
+import traceback
 import cv2
 import numpy as np
 
 # Feature modules.
 import hough_transform
+import orientation_histogram
 import optical_flow
+import sparse_flow
 import laws_mask
+import radon_transform
 import history
+import cache
+import prepared_frame
+import layout
+import worker
+import parallel
+import windows
 
 
 class FeatureExtractor(object):
-    def __init__(self, feature_queue, init_image, window_size, overlap, cmd_history_feats, cmd_history_length, nav_history_feats, nav_history_length):
-        self.feature_queue = feature_queue
+    """ Extracts the visual and history features of a frame.
+
+        The visual features are extracted over the windows given by
+        window_size and overlap (see windows.get_spec). The flow, Law's and
+        Hough blocks are extracted in the modes given by flow_mode, laws_mode
+        and hough_mode (see get_mode), the structure block is either 'hough'
+        or 'orientation' and use_radon adds a block of Radon transform
+        features. The features are written into preallocated rows of the
+        given dtype named by the feature layout (see layout.py).
+
+        Frames passed to extract are extracted by a long-lived worker thread
+        (see worker.py), spread over that many processes if processes is
+        given (see parallel.py), and their results are fetched with
+        get_result. The rows are reused, so a result should be used or
+        copied before two more frames are extracted.
+
+        To save time, blocks that would overrun budget seconds reuse their
+        last features (see get_visual_features), blocks are looked up in a
+        feature cache (see get_block_features), windows that changed less
+        than change_threshold reuse theirs (see get_changed_features) and a
+        pruning plan leaves out the cells a linear model barely weighs (see
+        pruning.py).
+    """
+    # The visual feature blocks, most expensive first. The structure block is
+    # either 'hough' or 'orientation'.
+    VISUAL_BLOCKS = ['flow', 'laws', 'hough']
+    STRUCTURE_BLOCKS = ['hough', 'orientation']
+
+    # The visual feature blocks whose windows can be extracted on their own
+    # from just the part of the frame covering them, so their window features
+    # can be reused or pruned. Only the Law's features come out exactly the
+    # same as when the whole frame is extracted.
+    REUSABLE_BLOCKS = ['laws', 'hough']
+    EXACT_BLOCKS = ['laws']
+
+    # Margin in pixels around the changed windows needed for their features
+    # to match those of the whole frame (the reach of the 5x5 Law's masks
+    # and of the Canny edge detector).
+    CHANGE_MARGIN = 3
+
+    # The rate at which the measured costs of the blocks are averaged in.
+    COST_RATE = 0.2
+
+    def __init__(self, init_image, window_size, overlap, cmd_history_feats, cmd_history_length, nav_history_feats, nav_history_length,
+                 flow_mode='frame', flow_scale=0.5, flow_tier=None, laws_mode='frame', hough_mode='frame', structure='hough',
+                 use_radon=False, drop_policy='drop-oldest', processes=0, budget=None, priority=None, max_skips=3,
+                 cache=None, change_threshold=None, change_scale=0.25, pruning=None, dtype='float64'):
         self.init_image = init_image
-        self.window_size = window_size
-        self.overlap = overlap
+        self.window_spec = windows.get_spec(window_size, overlap)
+        self.window_size = self.window_spec.window_size
+        self.overlap = self.window_spec.overlap
         self.cmd_history_feats = cmd_history_feats
         self.cmd_history_length = cmd_history_length
         self.nav_history_feats = nav_history_feats
         self.nav_history_length = nav_history_length
+        self.flow_mode = flow_mode
+        self.flow_scale = flow_scale
+        self.flow_tier = flow_tier
+        self.flow_tier_request = None
+        self.laws_mode = laws_mode
+        self.hough_mode = hough_mode
+        self.structure = structure
+        self.use_radon = use_radon
+        self.visual_blocks = [structure if name == 'hough' else name for name in self.VISUAL_BLOCKS] + (['radon'] if use_radon else [])
+        self.budget = budget
+        self.priority = priority if priority is not None else self.visual_blocks
+        self.max_skips = max_skips
+        self.cache = cache
+        self.change_threshold = change_threshold
+        self.change_scale = change_scale
+        self.pruning = pruning
+        self.dtype = np.dtype(dtype)
+        self.prediction = None
         self.init_feature_extract()
 
-    def extract(self, image):
-        t = threading.Thread(target=self.get_features, args=(image,))
-        t.start()
+        # Fork the extraction processes before the worker thread is started
+        # (see parallel.ParallelExtractor about threads started before).
+        self.parallel = None
+        if processes > 0:
+            self.parallel = parallel.ParallelExtractor(self, processes)
+
+        # The history is updated by the caller while the worker extracts it.
+        self.history_lock = threading.Lock()
+
+        self.worker = worker.ExtractionWorker(self.get_result_features, drop_policy)
+        self.worker.start()
+
+    def extract(self, image, frame_buffer=None):
+        """ Submits the image to the extraction worker and returns its
+            sequence number, or None if it was dropped. A reference to the
+            frame buffer holding the image can be handed over, which is
+            released once the image is extracted or dropped.
+        """
+        return self.worker.submit(image, frame_buffer)
+
+    def get_result(self, seq=None, timeout=None):
+        """ Returns the newest extraction result, see
+            ExtractionWorker.get_result.
+        """
+        return self.worker.get_result(seq, timeout)
+
+    def stop(self):
+        self.worker.stop()
+        if self.parallel is not None:
+            self.parallel.stop()
+
+    def set_flow_tier(self, tier):
+        """ Asks for the flow of the next frames to be solved at the given
+            quality tier (None for the original parameters). The tier is
+            switched by the thread extracting the features before the next
+            frame, so this can be called from any thread. The layout does not
+            record the tier.
+        """
+        if self.flow_mode != 'frame':
+            raise ValueError("flow tiers need flow mode 'frame', not %s" % self.flow_mode)
+        if tier is not None and tier not in optical_flow.OpticalFlow.TIERS:
+            raise ValueError("flow tier %s is not one of %s" % (tier, ', '.join(sorted(optical_flow.OpticalFlow.TIERS))))
+        self.flow_tier_request = (tier,)
+
+    def apply_flow_tier(self, tier):
+        """ Switches the flow to the given quality tier.
+        """
+        self.flow_tier = tier
+        self.extractor_opt_flow.set_tier(tier)
+        self.costs['flow'] = self.extractor_opt_flow.get_cost()
+        self.config_hashes['flow'] = cache.hash_config(self.get_block_config('flow'))
+        if self.parallel is not None:
+            self.parallel.set_flow_tier(tier)
+
+    def set_prediction(self, prediction):
+        """ Sets the streaming prediction the blocks of the frames extracted
+            by the worker are added to as they are extracted (None for none),
+            the history blocks first, so a partial prediction is ready before
+            the whole feature row is. Its blocks start out from the last
+            features of each block.
+        """
+        if prediction is not None:
+            prediction.reset(self.last_feats)
+        self.prediction = prediction
 
     def update(self, cmd, navdata):
-        self.extractor_nav_history.update(navdata)
-        self.extractor_cmd_history.update(cmd)
+        with self.history_lock:
+            self.extractor_nav_history.update(navdata)
+            self.extractor_cmd_history.update(cmd)
 
     def init_feature_extract(self):
-        # Grab an example window from the initial image to feed the optical flow
-        # feature extractor (use a non border window).
-        windows = get_windows(self.init_image, self.window_size, self.overlap)
-        small_image = self.init_image[windows[1][1][2]:windows[1][1][3], windows[1][1][0]:windows[1][1][1]]
+        plan = windows.get_plan(self.init_image.shape, self.window_spec)
+        if self.structure not in self.STRUCTURE_BLOCKS:
+            raise ValueError("structure %s is not 'hough' or 'orientation'" % self.structure)
+        for name in self.visual_blocks:
+            if self.get_mode(name) == 'window' and not self.window_spec.is_uniform():
+                raise ValueError("%s mode 'window' needs a uniform window grid" % name)
 
         # Initialize each feature extractor.
-        self.extractor_opt_flow = optical_flow.OpticalFlow(small_image)
-        self.extractor_hough_trans = hough_transform.HoughTransform()
+        if self.flow_tier is not None and self.flow_mode != 'frame':
+            raise ValueError("flow tiers need flow mode 'frame', not %s" % self.flow_mode)
+        if self.flow_mode == 'frame':
+            self.extractor_opt_flow = optical_flow.OpticalFlow(self.init_image, self.flow_scale, self.flow_tier)
+        elif self.flow_mode == 'window':
+            # Grab an example window from the initial image to feed the
+            # optical flow feature extractor (all windows have the same size).
+            small_image = plan.get_views(self.init_image)[1, 1]
+            self.extractor_opt_flow = optical_flow.OpticalFlow(small_image)
+        elif self.flow_mode == 'sparse':
+            self.extractor_opt_flow = sparse_flow.SparseOpticalFlow(self.init_image, self.flow_scale)
+        else:
+            raise ValueError("flow mode %s is not 'frame', 'window' or 'sparse'" % self.flow_mode)
+        if self.laws_mode not in ('frame', 'window'):
+            raise ValueError("laws mode %s is not 'frame' or 'window'" % self.laws_mode)
+        if self.hough_mode not in ('frame', 'window'):
+            raise ValueError("hough mode %s is not 'frame' or 'window'" % self.hough_mode)
+        self.extractor_hough_trans = hough_transform.HoughTransform() if self.structure == 'hough' else None
+        self.extractor_orientation = orientation_histogram.OrientationHistogram(self.init_image) if self.structure == 'orientation' else None
         self.extractor_laws_mask = laws_mask.LawsMask()
-        self.extractor_cmd_history = history.CmdHistory(self.cmd_history_feats, self.cmd_history_length)
-        self.extractor_nav_history = history.NavHistory(self.nav_history_feats, self.nav_history_length)
-
-    def get_visual_features(self, image):
-        # Get the windows from the current image.
-        windows = get_windows(image, self.window_size, self.overlap)
-
-        # Arrays that will contain the different features.
-        feats_all = np.array([])
-        feats_flow = np.array([])
-        feats_hough = np.array([])
-        feats_laws = np.array([])
-
-        # Iterate through the windows, computing features for each.
-        for r in range(0, self.window_size[1]):
-            for c in range(0, self.window_size[0]):
-                # Get the current window of the image for which the features
-                # will be extracted from.
-                cur_window = image[windows[r][c][2]:windows[r][c][3], windows[r][c][0]:windows[r][c][1]]
-
-                # If the current window is a border window, it may have a
-                # smaller size, so reshape it.
-                cur_window = cv2.resize(cur_window, self.extractor_opt_flow.shape[::-1])
-
-                # Get the optical flow features from the current window.
+        self.extractor_radon = radon_transform.RadonTransform(self.init_image) if self.use_radon else None
+        self.extractor_cmd_history = history.CmdHistory(self.cmd_history_feats, self.cmd_history_length, dtype=self.dtype)
+        self.extractor_nav_history = history.NavHistory(self.nav_history_feats, self.nav_history_length, dtype=self.dtype)
+        self.init_layout()
+
+        # The costs each visual extractor declares, the number of frames in a
+        # row each block has been skipped and the last features of each.
+        self.costs = {
+            'flow': self.extractor_opt_flow.get_cost(),
+            'hough': hough_transform.HoughTransform.COST,
+            'orientation': orientation_histogram.OrientationHistogram.COST,
+            'laws': laws_mask.LawsMask.COST,
+            'radon': radon_transform.RadonTransform.COST
+        }
+        self.skip_counts = dict((name, 0) for name in self.visual_blocks)
+        self.skipped = []
+        self.last_feats = self.layout.get_buffer()
+
+        # The cells of each block that are extracted. Pruned cells are filled
+        # in once and never written again, and pruned blocks are dropped from
+        # the extraction order.
+        self.kept = dict((b['NAME'], np.ones(b['COUNT'], dtype=bool)) for b in self.layout.blocks)
+        if self.pruning is not None:
+            self.pruning.check(self.layout)
+            for b in self.layout.blocks:
+                self.kept[b['NAME']] = self.pruning.get_kept(b['NAME'], b['COUNT'])
+            for buf in self.buffers + [self.last_feats]:
+                buf[0, :] = self.pruning.fill
+            self.priority = [name for name in self.priority if self.kept[name].any()]
+
+        # The hash of the configuration of each visual block and of the last
+        # frame the optical flow saw, which key the feature cache.
+        self.config_hashes = dict((name, cache.hash_config(self.get_block_config(name))) for name in self.visual_blocks)
+        self.prev_hash = prepared_frame.prepare(self.init_image).get_hash()
+
+        # The shape of the downscaled gray frames and the crop of the one
+        # each window of each reusable block was last extracted from, and the
+        # number of windows reused and extracted.
+        self.change_refs = {}
+        self.reuse_hits = 0
+        self.reuse_misses = 0
+
+    def init_layout(self):
+        """ Lays out the feature vector and preallocates the buffers the
+            features are written into. Two buffers are used in turn so the
+            features of the previous frame are not overwritten while they
+            are still being used.
+        """
+        num_windows = self.window_spec.size
+        spec = None if self.window_spec.is_uniform() else self.window_spec.config()
+        self.layout = layout.FeatureLayout(dtype=self.dtype)
+        self.layout.add_block('flow', optical_flow.OpticalFlow.FEATURES, num_windows, spec, self.get_extractor_config('flow'))
+        if self.structure == 'hough':
+            self.layout.add_block('hough', hough_transform.HoughTransform.FEATURES, num_windows, spec, self.get_extractor_config('hough'))
+        else:
+            self.layout.add_block('orientation', orientation_histogram.OrientationHistogram.FEATURES, num_windows, spec, self.get_extractor_config('orientation'))
+        self.layout.add_block('laws', laws_mask.LawsMask.FEATURES, num_windows, spec, self.get_extractor_config('laws'))
+        if self.use_radon:
+            self.layout.add_block('radon', radon_transform.RadonTransform.FEATURES, radon_transform.RadonTransform.NUM_ANGLES, config=self.get_extractor_config('radon'))
+        self.layout.add_block('cmd_history', history.CmdHistory.FEATURES, self.extractor_cmd_history.spacing.shape[0])
+        self.layout.add_block('nav_history', history.NavHistory.FEATURES, self.extractor_nav_history.spacing.shape[0])
+        self.buffers = [self.layout.get_buffer(), self.layout.get_buffer()]
+        self.buffer_index = 0
+
+    def get_visual_features(self, image, feats=None, blocks=None):
+        """ Writes the visual features of the image into their blocks of the
+            feature row, allocating the row if not given, and returns it.
+            Only the given visual blocks are extracted if blocks is given, as
+            the extraction processes do, otherwise all of them are in order of
+            priority, spread over the extraction processes if there are any.
+
+            With a budget and no processes, unless blocks is given, a block
+            whose expected cost would overrun the budget is skipped and filled
+            in with its last known features, unless it has already been
+            skipped max_skips frames in a row. The expected costs start from
+            those the extractors declare and are refined as frames are
+            extracted. The names of the skipped blocks are kept in skipped.
+        """
+        feats = feats if feats is not None else self.layout.get_buffer()
+        self.skipped = []
+        (request, self.flow_tier_request) = (self.flow_tier_request, None)
+        if request is not None:
+            self.apply_flow_tier(request[0])
+        budget = None
+        if blocks is None:
+            if self.parallel is not None:
+                self.parallel.get_visual_features(image, feats)
+                self.add_prediction(self.priority, feats)
+                return feats
+            blocks = self.priority
+            budget = self.budget
+
+        # Share the conversions of the frame between all of the extractors.
+        image = prepared_frame.prepare(image)
+
+        # Get the plan of the windows of the current image.
+        plan = windows.get_plan(image.shape, self.window_spec)
+
+        start_time = time.time()
+        for name in blocks:
+            cols = self.layout.slices[name]
+            if budget is not None and self.skip_counts[name] < self.max_skips:
+                if time.time() - start_time + self.costs[name] > budget:
+                    feats[0, cols] = self.last_feats[0, cols]
+                    self.skip_counts[name] += 1
+                    self.skipped.append(name)
+                    self.add_prediction([name], feats)
+                    continue
+
+            block_start_time = time.time()
+            self.get_block_features(name, image, plan, self.layout.get_view(feats, name))
+            self.last_feats[0, cols] = feats[0, cols]
+            self.skip_counts[name] = 0
+            self.add_prediction([name], feats)
+
+            # Refine the expected cost of the block.
+            cost = time.time() - block_start_time
+            self.costs[name] += self.COST_RATE*(cost - self.costs[name])
+
+        return feats
+
+    def get_block_features(self, name, image, plan, feats):
+        """ Extracts the features of a single visual block into its view of
+            the feature row, going through the feature cache if there is one.
+            Cached features are keyed by the content of the frame and the
+            configuration of the block, and those of the flow by the content
+            of the previous frame too. The flow at a tier and the sparse flow
+            are never cached.
+        """
+        if self.change_threshold is not None and name in self.REUSABLE_BLOCKS:
+            # Reused features depend on the frames before, so they are not
+            # cached.
+            self.get_changed_features(name, image, plan, feats)
+            return
+        indices = None if self.kept[name].all() else np.flatnonzero(self.kept[name])
+        if self.cache is None or self.get_mode(name) == 'sparse' or (name == 'flow' and self.flow_tier is not None):
+            # The sparse flow depends on every frame before through the
+            # corners it tracks, and the flow at a tier starts from the flow
+            # of the frame before, so neither is cached.
+            if self.cache is not None and name == 'flow':
+                self.prev_hash = image.get_hash()
+            self.extract_block_features(name, image, plan, feats, indices)
+            return
+
+        frame_hash = image.get_hash()
+        if name == 'flow':
+            frame_hash = hashlib.sha1(self.prev_hash + frame_hash).hexdigest()
+            self.prev_hash = image.get_hash()
+        cached = self.cache.get(name, self.config_hashes[name], frame_hash)
+        if cached is not None and cached.shape == feats.shape:
+            feats[...] = cached
+            if name == 'flow':
+                # Keep solving the flow against the last frame.
+                if self.flow_mode == 'frame':
+                    self.extractor_opt_flow.set_prev(image)
+                else:
+                    last = np.flatnonzero(self.kept[name])[-1]
+                    self.extractor_opt_flow.set_prev(plan.get_views(image.image)[last // self.window_size[0], last % self.window_size[0]])
+            return
+        self.extract_block_features(name, image, plan, feats, indices)
+        self.cache.put(name, self.config_hashes[name], frame_hash, feats)
+
+    def get_changed_features(self, name, image, plan, feats):
+        """ Extracts the features of the windows of a reusable block that
+            have changed and reuses the last features of the others. A window
+            has changed when the mean absolute difference of the gray frame
+            downscaled by change_scale over the window, against the frame its
+            features were last extracted from, is over the threshold (in gray
+            levels). Only the part of the frame covering the changed windows
+            is extracted, so Hough lines reaching into them from unchanged
+            windows can be missed. The windows reused and extracted are
+            counted in reuse_hits and reuse_misses.
+        """
+        small = image.get_gray(self.change_scale)
+        small_pool = plan.get_pool(small.shape, self.change_scale)
+        slices = small_pool.slices()
+
+        # Each window is compared against its own crop of the frame its
+        # features were last extracted from, as windows overlap.
+        (shape, refs) = self.change_refs.get(name, (None, None))
+        if shape != small.shape:
+            changed = np.ones(small_pool.size, dtype=bool)
+            refs = [None]*small_pool.size
+            self.change_refs[name] = (small.shape, refs)
+        else:
+            changed = np.zeros(small_pool.size, dtype=bool)
+            for i in np.flatnonzero(self.kept[name]):
+                changed[i] = cv2.absdiff(small[slices[i]], refs[i]).mean() > self.change_threshold
+        changed &= self.kept[name]
+        indices = np.flatnonzero(changed)
+
+        feats[~changed] = self.layout.get_view(self.last_feats, name)[~changed]
+        self.reuse_hits += np.count_nonzero(self.kept[name]) - indices.shape[0]
+        self.reuse_misses += indices.shape[0]
+        if indices.shape[0] == 0:
+            return
+        self.extract_block_features(name, image, plan, feats, None if changed.all() else indices, exact=False)
+
+        # The changed windows are now compared against this frame.
+        for i in indices:
+            refs[i] = small[slices[i]].copy()
+
+    def extract_block_features(self, name, image, plan, feats, indices=None, exact=True):
+        """ Extracts the features of a single visual block into its view of
+            the feature row. Only the features of the windows given by
+            indices need to be extracted if given. In frame mode the part of
+            the frame covering them is extracted if the block supports it
+            (exactly if exact is set), otherwise the whole frame is and only
+            the given windows are pooled. Only the given windows are written,
+            so pruned cells keep their fill values.
+        """
+        croppable = self.EXACT_BLOCKS if exact else self.REUSABLE_BLOCKS
+        if indices is not None and self.get_mode(name) == 'frame' and name in croppable:
+            # Extract just the part of the frame covering the windows.
+            (crop, pool) = plan.get_pool(image.shape).crop(indices, self.CHANGE_MARGIN)
+            part = prepared_frame.prepare(image.image[crop])
+            if name == 'hough':
+                feats[indices] = self.extractor_hough_trans.extract_frame(part, pool)
+            elif name == 'laws':
+                feats[indices] = self.extractor_laws_mask.extract_frame(part, pool)
+            return
+
+        # The cells written, leaving the fill values of pruned cells alone.
+        rows = slice(None) if indices is None else indices
+
+        if self.get_mode(name) == 'sparse':
+            # Every window is tracked so the corners do not depend on pruning.
+            pool = plan.get_pool(self.extractor_opt_flow.shape, self.flow_scale)
+            feats[rows] = self.extractor_opt_flow.extract_frame(image, pool)[rows]
+            return
+
+        if self.get_mode(name) == 'frame':
+            if name == 'flow':
+                # The flow is solved once for the whole frame and then pooled
+                # over the windows scaled to the flow field.
+                flow = self.extractor_opt_flow.extract(image)
+                pool = select(plan.get_pool(flow.shape, self.flow_scale), indices)
+                feats[rows] = optical_flow.OpticalFlow.get_window_features(flow, pool)
+            elif name == 'hough':
+                pool = select(plan.get_pool(image.shape), indices)
+                feats[rows] = self.extractor_hough_trans.extract_frame(image, pool)
+            elif name == 'laws':
+                feats[...] = self.extractor_laws_mask.extract_frame(image, plan.get_pool(image.shape))
+            elif name == 'orientation':
+                pool = plan.get_pool(self.extractor_orientation.shape, self.extractor_orientation.scale)
+                feats[rows] = self.extractor_orientation.extract_frame(image, select(pool, indices))
+            elif name == 'radon':
+                feats[rows] = self.extractor_radon.extract(image)[rows]
+            return
+
+        # Iterate through the windows, computing features for each. The frame
+        # is padded so that border windows have the same size as the others.
+        views = plan.get_views(image.image)
+        indices = range(0, self.window_spec.size) if indices is None else indices
+        for i in indices:
+            cur_window = views[i // self.window_size[0], i % self.window_size[0]]
+            if name == 'flow':
                 flow = self.extractor_opt_flow.extract(cur_window)
-                feats_cur = optical_flow.OpticalFlow.get_features(flow)
-                feats_flow = np.vstack((feats_flow, feats_cur)) if feats_flow.size else feats_cur
-
-                # Get the Hough transform features from the current window.
+                feats[i, :] = optical_flow.OpticalFlow.get_features(flow)[:, 0]
+            elif name == 'hough':
                 lines = self.extractor_hough_trans.extract(cur_window)
-                feats_cur = hough_transform.HoughTransform.get_features(lines)
-                feats_hough = np.vstack((feats_hough, feats_cur)) if feats_hough.size else feats_cur
-
-                # Get the Law's texture mask features from the current window.
-                feats_cur = self.extractor_laws_mask.extract(cur_window)
-                feats_laws = np.vstack((feats_laws, feats_cur)) if feats_laws.size else feats_cur
-
-        # Vertically stack all of the different features.
-        feats_all = np.vstack((feats_all, feats_flow)) if feats_all.size else feats_flow
-        feats_all = np.vstack((feats_all, feats_hough)) if feats_all.size else feats_hough
-        feats_all = np.vstack((feats_all, feats_laws)) if feats_all.size else feats_laws
-
-        # Transpose and return.
-        return np.transpose(feats_all)
-
-    def get_nav_features(self):
-        # Get the command and navigation data history features.
-        feats_cmd_history = self.extractor_cmd_history.extract()
-        feats_nav_history = self.extractor_nav_history.extract()
-        feats_all = np.vstack((feats_cmd_history, feats_nav_history))
-        return np.transpose(feats_all)
+                feats[i, :] = hough_transform.HoughTransform.get_features(lines)[:, 0]
+            elif name == 'laws':
+                feats[i, :] = self.extractor_laws_mask.extract(cur_window)[:, 0]
+
+    def get_extractor_config(self, name, tier=False):
+        """ Returns the mode and parameters of the extractor of the visual
+            block, which its block of the layout records. The parameters set
+            by the flow tier are left out unless tier is True, since the tier
+            can be switched while extracting and the features of every tier
+            are used alike.
+        """
+        extractor = {
+            'flow': self.extractor_opt_flow,
+            'hough': self.extractor_hough_trans,
+            'orientation': self.extractor_orientation,
+            'laws': self.extractor_laws_mask,
+            'radon': self.extractor_radon
+        }[name]
+        if isinstance(extractor, optical_flow.OpticalFlow):
+            return {'MODE': self.get_mode(name), 'PARAMS': extractor.config(tier)}
+        return {'MODE': self.get_mode(name), 'PARAMS': extractor.config()}
+
+    def get_block_config(self, name):
+        """ Returns everything the features of the visual block depend on.
+        """
+        config = {
+            'NAME': name,
+            'WINDOWS': self.window_spec.config(),
+            'STATS': self.layout.get_block(name)['STATS'],
+            'KEPT': np.flatnonzero(self.kept[name]).tolist(),
+            'DTYPE': self.dtype.name
+        }
+        config.update(self.get_extractor_config(name, tier=True))
+        return config
+
+    def get_mode(self, name):
+        """ Returns whether the visual block is extracted in 'frame' or
+            'window' mode (or 'sparse' mode for the flow, see sparse_flow.py).
+            In 'frame' mode the whole frame is extracted once, the flow
+            downscaled by flow_scale and at the tier given by flow_tier, and
+            the features of each window are pooled from it. 'window' mode
+            extracts every window on its own, padding the border windows by
+            reflection where older datasets resized them, so it only
+            approximates the features of those datasets. The orientation
+            histograms and the Radon transform are always taken of the frame.
+        """
+        return {'flow': self.flow_mode, 'hough': self.hough_mode, 'laws': self.laws_mode, 'orientation': 'frame', 'radon': 'frame'}[name]
+
+    def get_nav_features(self, feats=None):
+        """ Writes the command and navigation data history features into
+            their blocks of the feature row, allocating the row if not given,
+            and returns it.
+        """
+        feats = feats if feats is not None else self.layout.get_buffer()
+        with self.history_lock:
+            feats[0, self.layout.slices['cmd_history']] = self.extractor_cmd_history.extract()[:, 0]
+            feats[0, self.layout.slices['nav_history']] = self.extractor_nav_history.extract()[:, 0]
+        self.add_prediction(['cmd_history', 'nav_history'], feats)
+        return feats
+
+    def add_prediction(self, blocks, feats):
+        """ Adds the given blocks of the feature row to the streaming
+            prediction, if there is one.
+        """
+        if self.prediction is not None:
+            for name in blocks:
+                self.prediction.add(name, feats)
 
     def get_features(self, image):
-        visual_features = self.get_visual_features(image)
-        nav_features = self.get_nav_features()
-        feats = np.hstack((visual_features, nav_features))
-        self.feature_queue.put(feats)
+        """ Extracts the features of the image into the next preallocated
+            feature row and returns it. The history blocks are extracted
+            first.
+        """
+        feats = self.buffers[self.buffer_index]
+        self.buffer_index = (self.buffer_index + 1) % len(self.buffers)
+
+        image = prepared_frame.prepare(image)
+        self.get_nav_features(feats)
+        self.get_visual_features(image, feats)
+        return feats
+
+    def get_result_features(self, image):
+        """ Extracts the features of the image for the extraction worker
+            along with the visual blocks skipped to stay within budget.
+        """
+        prediction = self.prediction
+        if prediction is not None:
+            prediction.start(self.worker.extracting)
+        try:
+            feats = self.get_features(image)
+        except Exception:
+            if prediction is not None:
+                prediction.fail(traceback.format_exc())
+            raise
+        if prediction is not None:
+            prediction.finish()
+        return {'FEATURES': feats, 'SKIPPED': list(self.skipped)}
+
+
+def select(pool, indices):
+    """ Returns a window pool of just the windows given by indices, or the
+        whole pool if indices is None.
+    """
+    return pool if indices is None else pool.select(indices)
 
 
 def get_windows(image, window_size, percent_overlap):
@@ -111,31 +573,16 @@ def get_windows(image, window_size, percent_overlap):
 
         Descritizes the image into a bunch of cells with a size given by
         window_size, a 2-tuple specifying the size of the x and y
-        descritizations. The percentage of each image which overlaps its
-        neighbors is given by percent_overlap.
+        descritizations, or a window spec. The percentage of each image which
+        overlaps its neighbors is given by percent_overlap. The windows come
+        from the memoized window plan of the image's shape (see windows.py).
     """
-    (y, x, d) = image.shape
-    length = (x/window_size[0], y/window_size[1])
-    overlap = (int(math.floor(length[0]*percent_overlap/4)), int(math.floor(length[1]*percent_overlap/4)))
-
-    # Matrix that will hold the window sizes.
-    windows = [[None for z in range(0, window_size[0])] for z in range(0, window_size[1])]
-    for r in range(0, window_size[1]):
-        for c in range(0, window_size[0]):
-            x_start = length[0]*(c) - overlap[0]
-            x_end   = length[0]*(c + 1) + overlap[0]
-            y_start = length[1]*(r) - overlap[1]
-            y_end   = length[1]*(r + 1) + overlap[1]
-            windows[r][c] = (x_start, x_end, y_start, y_end)
-
-    windows = [[tuple(j if j > 0 else 0 for j in i) for i in k] for k in windows]  # remove bad (negative) values
-    return windows
+    return windows.get_plan(image.shape, window_size, percent_overlap).windows
 
 
 def _test_feature_extractor():
     pdb.set_trace()
 
-    feature_queue = Queue.Queue(maxsize=1)
     init_image = cv2.imread('../samples/test_forest.jpg')
     window_size = (10, 5)
     overlap = 0.25
@@ -144,8 +591,7 @@ def _test_feature_extractor():
     nav_history_feats = 7    # the approximate number of nav history features
     nav_history_length = 10  # keep a running list of the last 10 nav data
 
-    fe = FeatureExtractor(feature_queue,
-                          init_image,
+    fe = FeatureExtractor(init_image,
                           window_size,
                           overlap,
                           cmd_history_feats,
@@ -154,16 +600,18 @@ def _test_feature_extractor():
                           nav_history_length)
     
     pdb.set_trace()
-    fe.extract(init_image, '', '')
-
-    while True:
-        blah = None
-        try:
-            blah = feature_queue.get(block=False)
-        except Queue.Empty:
-            pass
-        if blah is not None:
-            break
+    seq = fe.extract(init_image)
+    result = fe.get_result(seq, timeout=10.0)
+    assert result is not None and result['SEQ'] == seq
+    assert result['FEATURES'].shape == (1, fe.layout.size)
+
+    # A frame failing to extract reports its error and the worker carries on.
+    seq = fe.extract(None)
+    result = fe.get_result(seq, timeout=10.0)
+    assert result['SEQ'] == seq and 'ERROR' in result
+    seq = fe.extract(init_image)
+    assert 'FEATURES' in fe.get_result(seq, timeout=10.0)
+    fe.stop()
 
     print('Success.')
 
@@ -6,6 +6,11 @@
 import numpy as np
 
 
+# Parameters of the sinc-window low pass filter.
+SINC_CUTOFF = 0.1       # cutoff frequency (fraction of sample rate)
+SINC_BANDWIDTH = 0.01   # transition bandwidth
+
+
 def get_spacing(max_length, num_feats, func='linear'):
     """ Creates an array containing indices for spacing a time period.
     """
@@ -20,26 +25,21 @@ def get_spacing(max_length, num_feats, func='linear'):
 
 def low_pass_average(array, spacing):
     """ Passes an array through an averaging low pass filter.
+
+        The array holds the newest sample in its first column. This computes
+        the same features as History.extract does incrementally.
     """
-    result = []
-    length = spacing.shape
-    length = length[0]
-    for i in range(0, length):
+    (channels, _) = array.shape
+    result = np.zeros((channels*spacing.shape[0], 1))
+    for i in range(0, spacing.shape[0]):
         time_slice = array[:, 0:spacing[i]]
-        if time_slice.shape[1] == 1:
-            result = np.vstack((result, time_slice)) if len(result) else time_slice
-        else:
-            mean = np.mean(time_slice, 1)
-            mean.shape = (mean.shape[0], 1)
-            result = np.vstack((result, mean))
+        result[i*channels:(i + 1)*channels, 0] = np.mean(time_slice, 1)
     return result
 
 
-def low_pass_sinc_window(array, spacing):
-    """ Passes an array through a sinc-window low pass filter.
+def get_sinc_kernel(fc=SINC_CUTOFF, b=SINC_BANDWIDTH):
+    """ Computes the Blackman windowed sinc low pass filter kernel.
     """
-    fc = 0.1                        # cutoff frequency (fraction of sample rate)
-    b = 0.01                        # transition bandwidth
     N = int(np.ceil((4/b)))
     N = N if N % 2 else N + 1       # make sure N is odd
     n = np.arange(N)
@@ -56,97 +56,141 @@ def low_pass_sinc_window(array, spacing):
 
     # Normalize to get unity gain.
     h = h/np.sum(h)
+    return h
 
-    result = []
-    length = spacing.shape
-    length = length[0]
-    for i in range(0, length):
-        time_slice = array[:, 0:spacing[i]]
-        if time_slice.shape[1] == 1:
-            result = np.vstack((result, time_slice)) if len(result) else time_slice
-        else:
-            # Convolve the filter with the signal.
-            conv = np.convolve(array, h)
 
-            conv.shape = (conv.shape[0], 1)
-            result = np.vstack((result, conv))
-    return result
+class History(object):
+    """ Incremental history of a vector of signals.
 
+        The last max_length samples are kept in a circular buffer, so adding
+        a sample never moves the others. For the averaging filter a running
+        sum of the newest samples is kept for every time period in the
+        spacing; each update adds the new sample and subtracts the one
+        leaving the period. For the sinc-window filter the kernel is
+        computed once and a streaming FIR state holding the last samples the
+        kernel spans is kept, so each update filters just the new sample. The
+        sinc features are the filtered signal at the age of each time period.
 
-class CmdHistory(object):
-    """ Command history features.
+        Updating and extracting therefore cost the same no matter how long
+        the history is and neither allocates. Samples, sums and features are
+        kept in the given dtype.
     """
-    def __init__(self, num_feats, max_length):
+    # Number of updates after which the running sums are recomputed to keep
+    # rounding errors from building up.
+    RESYNC = 1000
+
+    def __init__(self, num_feats, max_length, channels=4, dtype=np.float64):
         self.num_feats = num_feats
         self.max_length = max_length
-        self.history = np.zeros((4, max_length))
+        self.channels = channels
+        self.dtype = np.dtype(dtype)
 
         # Create the spacing for the exponentially decreasing time periods.
         self.spacing = get_spacing(self.max_length, self.num_feats, func='log')
 
-    def update(self, cmd, form=False):
-        """ Updates the history with the specified command.
-
-            Argument form specifies specifies whether the command has been
-            transformed into a col vector or whether it is the same form as that
-            which is sent to the drone.
+        # The circular buffer, where head is the column of the newest sample,
+        # and the running sums of each time period.
+        self.history = np.zeros((channels, max_length), dtype=self.dtype)
+        self.head = 0
+        self.sums = np.zeros((channels, self.spacing.shape[0]), dtype=self.dtype)
+        self.leaving = np.zeros((channels, self.spacing.shape[0]), dtype=self.dtype)
+        self.updates = 0
+
+        # The reversed sinc kernel and the FIR state, which stores every
+        # sample twice so the last len(kernel) samples are always contiguous,
+        # along with a circular buffer of the filtered signal.
+        self.kernel = get_sinc_kernel()[::-1].astype(self.dtype)
+        self.taps = self.kernel.shape[0]
+        self.fir_state = np.zeros((channels, 2*self.taps), dtype=self.dtype)
+        self.fir_pos = 0
+        self.filtered = np.zeros((channels, max_length), dtype=self.dtype)
+        self.filtered_sample = np.zeros(channels, dtype=self.dtype)
+
+        # Preallocated features.
+        self.feats = np.zeros((channels*self.spacing.shape[0], 1), dtype=self.dtype)
+        self.feats_view = self.feats.reshape((self.spacing.shape[0], channels))
+        self.ages = np.zeros(self.spacing.shape[0], dtype=np.intp)
+
+    def push(self, sample):
+        """ Adds the newest sample to the history.
+        """
+        # The sample leaving each time period is the one whose age becomes
+        # the length of the period.
+        np.remainder(self.head + self.spacing - 1, self.max_length, out=self.ages)
+        np.take(self.history, self.ages, axis=1, out=self.leaving)
+        self.sums -= self.leaving
+        self.sums += np.reshape(sample, (self.channels, 1))
+        self.head = (self.head - 1) % self.max_length
+        self.history[:, self.head] = sample
+
+        # Filter the new sample.
+        self.fir_state[:, self.fir_pos] = sample
+        self.fir_state[:, self.fir_pos + self.taps] = sample
+        self.fir_pos = (self.fir_pos + 1) % self.taps
+        np.dot(self.fir_state[:, self.fir_pos:self.fir_pos + self.taps], self.kernel, out=self.filtered_sample)
+        self.filtered[:, self.head] = self.filtered_sample
+
+        self.updates += 1
+        if self.updates % self.RESYNC == 0:
+            self.resync()
+
+    def resync(self):
+        """ Recomputes the running sums from the history.
         """
-        self.history = np.roll(self.history, 1)
-        cmd_vec = cmd if form else np.transpose(np.array([cmd['X'], cmd['Y'], cmd['Z'], cmd['R']]))
-        self.history[:, 0] = cmd_vec
+        for (i, length) in enumerate(self.spacing):
+            ages = (self.head + np.arange(length)) % self.max_length
+            self.sums[:, i] = np.sum(self.history[:, ages], 1)
 
     def extract(self, low_pass_filter='average'):
-        """ Extracts the command history features.
+        """ Extracts the history features.
 
-            Filter can be 'average' or 'sinc'.
+            Filter can be 'average' or 'sinc'. The returned array is reused by
+            the next call.
         """
         if low_pass_filter == 'average':
-            func = low_pass_average
+            np.divide(self.sums, self.spacing, out=self.feats_view.T)
         elif low_pass_filter == 'sinc':
-            func = low_pass_sinc_window
-        feats = func(self.history, self.spacing)
-        return feats
+            np.remainder(self.head + self.spacing - 1, self.max_length, out=self.ages)
+            np.take(self.filtered, self.ages, axis=1, out=self.feats_view.T)
+        return self.feats
 
 
-class NavHistory(object):
-    """ Navigation history features.
+class CmdHistory(History):
+    """ Command history features.
     """
-    def __init__(self, num_feats, max_length):
-        self.num_feats = num_feats
-        self.max_length = max_length
-        self.history = np.zeros((4, max_length))
+    # Names of the features of each time period in order.
+    FEATURES = ['X', 'Y', 'Z', 'R']
 
-        # Create the spacing for the exponentially decreasing time periods.
-        self.spacing = get_spacing(self.max_length, self.num_feats, func='log')
+    def update(self, cmd, form=False):
+        """ Updates the history with the specified command.
 
-    def update(self, navdata, form=False):
-        """ Updates the navigation data history with the current navigation
-            data.
+            Argument form specifies specifies whether the command has been
+            transformed into a col vector or whether it is the same form as that
+            which is sent to the drone.
         """
-        # Parse the navigation data getting only the useful info and form it
-        # into an array.
-        useful_nav_data = []
-        if not form:
-            useful_nav_data.append(navdata['demo']['altitude'])
-            useful_nav_data.append(navdata['demo']['rotation']['pitch'])
-            useful_nav_data.append(navdata['demo']['rotation']['roll'])
-            useful_nav_data.append(navdata['demo']['rotation']['yaw'])
-        
-        useful_nav_data = np.array(useful_nav_data)
-        self.history = np.roll(self.history, 1)
-        self.history[:, 0] = useful_nav_data
+        cmd_vec = cmd if form else (cmd['X'], cmd['Y'], cmd['Z'], cmd['R'])
+        self.push(cmd_vec)
 
-    def extract(self, low_pass_filter='average'):
-        """ Extracts the navigation history features.
 
-            Filter can be 'average' or 'sinc'.
+class NavHistory(History):
+    """ Navigation history features.
+    """
+    # Names of the features of each time period in order.
+    FEATURES = ['ALTITUDE', 'PITCH', 'ROLL', 'YAW']
+
+    def update(self, navdata, form=False):
+        """ Updates the navigation data history with the current navigation
+            data.
         """
-        if low_pass_filter == 'average':
-            func = low_pass_average
-        elif low_pass_filter == 'sinc':
-            func = low_pass_sinc_window
-        feats = func(self.history, self.spacing)
-        return feats
+        # Parse the navigation data getting only the useful info.
+        if form:
+            useful_nav_data = navdata
+        else:
+            useful_nav_data = (navdata['demo']['altitude'],
+                               navdata['demo']['rotation']['pitch'],
+                               navdata['demo']['rotation']['roll'],
+                               navdata['demo']['rotation']['yaw'])
+        self.push(useful_nav_data)
 
 
 def _test_command_history():
@@ -169,6 +213,34 @@ def _test_command_history():
         print(sys.exc_info())
 
 
+def _test_navigation_history():
+    # Make sure the incremental features match those computed from scratch.
+    num_feats = 7
+    max_length = 300
+    nav_history = NavHistory(num_feats, max_length)
+    nav_history32 = NavHistory(num_feats, max_length, dtype=np.float32)
+    history = np.zeros((4, max_length))
+    signal = np.random.randn(4, 2500)
+    kernel = get_sinc_kernel()
+    for t in range(0, signal.shape[1]):
+        nav_history.update(signal[:, t], form=True)
+        nav_history32.update(signal[:, t], form=True)
+        history = np.roll(history, 1)
+        history[:, 0] = signal[:, t]
+    assert np.allclose(nav_history.extract(), low_pass_average(history, nav_history.spacing))
+
+    # The running sums in float32 stay close.
+    assert nav_history32.extract().dtype == np.float32
+    assert np.allclose(nav_history32.extract(), nav_history.extract(), atol=1e-4)
+    assert np.allclose(nav_history32.extract('sinc'), nav_history.extract('sinc'), atol=1e-4)
+
+    # The sinc features are the filtered signal at the age of each period.
+    filtered = np.array([np.convolve(signal[i], kernel)[0:signal.shape[1]] for i in range(0, 4)])
+    expected = filtered[:, signal.shape[1] - nav_history.spacing].T
+    assert np.allclose(nav_history.extract('sinc')[:, 0], expected.flatten())
+    print('Success.')
+
+
 if __name__ == '__main__':
     import pdb
     import sys
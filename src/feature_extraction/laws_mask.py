@@ -6,10 +6,25 @@
 import numpy as np
 import cv2
 
+from prepared_frame import prepare
+
 
 class LawsMask(object):
     """ Law's Mask features.
+
+        The texture energy of each window can be found in two ways. The
+        extract method filters a single window and is kept for reproducing
+        older datasets. The extract_frame method converts the whole frame to
+        YCrCb once, applies the separable 5x5 L5/E5/S5 bank to it with
+        cv2.sepFilter2D and pools the absolute energy of each filter response
+        over every window, which is far cheaper than filtering each window.
     """
+    # Names of the features returned by extract in order.
+    FEATURES = ['Y_LL', 'CR_LL', 'CB_LL', 'Y_LE', 'Y_LS', 'Y_EE', 'Y_ES', 'Y_SS']
+
+    # Rough cost in seconds of extracting a whole frame.
+    COST = 0.030
+
     def __init__(self):
         # Create the initial laws mask vectors.
         L3 = np.transpose(np.array([1, 2, 1]))
@@ -17,8 +32,8 @@ class LawsMask(object):
         S3 = np.transpose(np.array([-1, 2, -1]))
 
         L5 = np.transpose(np.array([1, 4, 6, 4, 1]))
-        E5 = np.transpose(np.array([-1, -2, 0, 1]))
-        S5 = np.transpose(np.array([-1, 0, 2, 0, 1]))
+        E5 = np.transpose(np.array([-1, -2, 0, 2, 1]))
+        S5 = np.transpose(np.array([-1, 0, 2, 0, -1]))
 
         self.LL3 = np.convolve(L3, np.transpose(L3))
         self.LE3 = np.convolve(L3, np.transpose(E3))
@@ -34,12 +49,33 @@ class LawsMask(object):
         self.ES5 = np.convolve(E5, np.transpose(S5))
         self.SS5 = np.convolve(S5, np.transpose(S5))
 
+        # The separable filter bank applied by extract_frame in the same
+        # order as the features returned by extract. Each entry holds the
+        # YCrCb channel to filter along with the vertical and horizontal
+        # kernels.
+        (Y, Cr, Cb) = (0, 1, 2)
+        (L5, E5, S5) = (np.float32(L5), np.float32(E5), np.float32(S5))
+        self.bank = [
+            (Y,  L5, L5),
+            (Cr, L5, L5),
+            (Cb, L5, L5),
+            (Y,  L5, E5),
+            (Y,  L5, S5),
+            (Y,  E5, E5),
+            (Y,  E5, S5),
+            (Y,  S5, S5)
+        ]
+
+    def config(self):
+        """ Returns the parameters the features depend on.
+        """
+        return {'BANK': [(channel, kernel_y.tolist(), kernel_x.tolist()) for (channel, kernel_y, kernel_x) in self.bank]}
+
     def extract(self, image, filter_size=5, convert=False):
         """ Extract Law's texture masks from the image. Make sure the image is
             in the YCrCb color space before calling this function.
         """
-        if convert:
-            image = cv2.cvtColor(cv2.imgCV_RGB2YCrCb)
+        image = prepare(image).get_ycrcb() if convert else prepare(image).image
 
         # Apply the filter.
         (Y, Cr, Cb) = cv2.split(image)
@@ -67,6 +103,22 @@ class LawsMask(object):
         features.shape = (features.shape[0], 1)
         return features
 
+    def extract_frame(self, image, pool, convert=True):
+        """ Extract Law's texture energy from every window of the frame at
+            once using a window pool. The frame is converted from BGR to
+            YCrCb unless convert is False. Returns an array with one row of
+            features per window.
+        """
+        image = prepare(image).get_ycrcb() if convert else prepare(image).image
+        channels = cv2.split(image)
+
+        # Filter the whole frame with each mask and pool the energy.
+        features = np.zeros((pool.size, len(self.bank)))
+        for (i, (channel, kernel_y, kernel_x)) in enumerate(self.bank):
+            response = cv2.sepFilter2D(channels[channel], cv2.CV_32F, kernel_x, kernel_y)
+            features[:, i] = pool.mean(np.abs(response, out=response))
+        return features
+
 
 def _test_laws_mask():
     sample_img_filenames = ['../../samples/test_forest.jpg']
@@ -0,0 +1,137 @@
+#!/usr/bin/env python2.7
+
+""" Fixed layout of the feature vector.
+"""
+
+import json
+import numpy as np
+
+
+class FeatureLayout(object):
+    """ Names every column of the feature vector.
+
+        The feature vector is made of blocks, one per extractor, each holding
+        the same statistics for a number of cells (the windows of a visual
+        extractor or the time periods of a history extractor). Blocks are laid
+        out one after the other and their cells are laid out one after the
+        other inside of them, so every block, cell and statistic has a fixed
+        column. Extractors write their features in place into the view of
+        their block in a preallocated buffer.
+
+        The layout is saved next to the features and the trained model so
+        the columns can be checked when either is loaded. Visual blocks also
+        record the mode and parameters of their extractor (CONFIG), so
+        features extracted differently, such as the sparse flow instead of
+        the dense one, do not match either.
+
+        Buffers hold features of the given dtype, float64 by default. In
+        float32 the rows take half the memory and are saved with half the
+        digits (see get_format), which is as much precision as the
+        extractors produce. The dtype does not change the columns, so it is
+        neither saved nor checked.
+    """
+    # The format each feature is saved in by dtype, the fewest digits that
+    # read back the same float32 and the numpy default otherwise.
+    FORMATS = {'float32': '%.9g', 'float64': '%.18e'}
+
+    def __init__(self, blocks=None, dtype=np.float64):
+        self.dtype = np.dtype(dtype)
+        self.blocks = []
+        self.slices = {}
+        self.shapes = {}
+        self.size = 0
+        for block in blocks or []:
+            self.add_block(block['NAME'], block['STATS'], block['COUNT'], block.get('WINDOWS'), block.get('CONFIG'))
+
+    def add_block(self, name, stats, count=1, windows=None, config=None):
+        """ Appends a block of count cells each holding the given statistics
+            and returns the slice of columns it takes up. The cells of a
+            visual block laid out on windows other than the uniform grid are
+            named by the configuration of their window spec (see windows.py),
+            so features of different windows do not match. The same goes for
+            the configuration of the block's extractor if given.
+        """
+        if name in self.slices:
+            raise ValueError('feature block %s is already in the layout' % name)
+        size = len(stats)*count
+        self.blocks.append({'NAME': name, 'STATS': list(stats), 'COUNT': count})
+        if windows is not None:
+            self.blocks[-1]['WINDOWS'] = windows
+        if config is not None:
+            # Keep the configuration as it reads back from the saved layout.
+            self.blocks[-1]['CONFIG'] = json.loads(json.dumps(config))
+        self.slices[name] = slice(self.size, self.size + size)
+        self.shapes[name] = (count, len(stats))
+        self.size += size
+        return self.slices[name]
+
+    def get_block(self, name):
+        for block in self.blocks:
+            if block['NAME'] == name:
+                return block
+        raise KeyError('feature block %s is not in the layout' % name)
+
+    def get_buffer(self):
+        """ Allocates a feature row to be filled in by the extractors.
+        """
+        return np.zeros((1, self.size), dtype=self.dtype)
+
+    def get_format(self):
+        """ Returns the format features are saved in with np.savetxt.
+        """
+        return self.FORMATS.get(self.dtype.name, '%.18e')
+
+    def get_view(self, features, name):
+        """ Returns a view into a feature row with one row per cell of the
+            block and one column per statistic.
+        """
+        return features[0, self.slices[name]].reshape(self.shapes[name])
+
+    def get_columns(self):
+        """ Returns the name of every column of the feature vector.
+        """
+        columns = []
+        for block in self.blocks:
+            for i in range(0, block['COUNT']):
+                for stat in block['STATS']:
+                    columns.append('%s[%s].%s' % (block['NAME'], i, stat))
+        return columns
+
+    def matches(self, other):
+        """ Returns whether the other layout names the same columns as this
+            one. Blocks saved before their configuration was recorded match
+            on their columns alone.
+        """
+        if len(self.blocks) != len(other.blocks):
+            return False
+        for (block, other_block) in zip(self.blocks, other.blocks):
+            if 'CONFIG' not in block or 'CONFIG' not in other_block:
+                block = dict((k, v) for (k, v) in block.items() if k != 'CONFIG')
+                other_block = dict((k, v) for (k, v) in other_block.items() if k != 'CONFIG')
+            if block != other_block:
+                return False
+        return True
+
+    def check(self, other):
+        """ Makes sure the other layout names the same columns as this one.
+        """
+        for (block, other_block) in zip(self.blocks, other.blocks):
+            if block['NAME'] != other_block['NAME'] or 'CONFIG' not in block or 'CONFIG' not in other_block:
+                continue
+            if block['CONFIG'] != other_block['CONFIG']:
+                raise ValueError('feature block %s was extracted with %s but expected %s' %
+                                 (block['NAME'], json.dumps(other_block['CONFIG'], sort_keys=True), json.dumps(block['CONFIG'], sort_keys=True)))
+        if not self.matches(other):
+            raise ValueError('feature layout does not match, expected %s columns (%s) but got %s columns (%s)' %
+                             (self.size, ', '.join(b['NAME'] for b in self.blocks),
+                              other.size, ', '.join(b['NAME'] for b in other.blocks)))
+
+    def save(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.blocks, f)
+
+    @staticmethod
+    def load(filename):
+        with open(filename, 'r') as f:
+            blocks = json.load(f)
+        return FeatureLayout(blocks)
@@ -6,6 +6,8 @@
 import numpy as np
 import cv2
 
+from prepared_frame import prepare
+
 
 class OpticalFlow(object):
     """ Extracts dense optical flow features from an image and its predecessor
@@ -21,12 +23,46 @@ class OpticalFlow(object):
 
         Source: [M. Werlberger, T. Pock, and H. Bischof. Motion estimation with
         non-local total variation regularization. In CVPR, 2010.]
+
+        The flow can be solved at one of the quality tiers in TIERS, which
+        can be switched at any time with set_tier. Each tier uses the DIS
+        optical flow preset given for it if OpenCV has it, and otherwise
+        Farneback with a reduced pyramid. Either way the flow of each frame
+        starts from the flow of the previous frame, kept in a preallocated
+        buffer. Without a tier the flow is solved from scratch with the
+        original Farneback parameters so older datasets can be reproduced.
+
+        Source: [T. Kroeger, R. Timofte, D. Dai and L. Van Gool, Fast optical
+        flow using dense inverse search, In ECCV, 2016.]
     """
-    def __init__(self, init_frame):
+    # Names of the features returned by get_features in order.
+    FEATURES = ['MIN', 'MAX', 'MEAN', 'STDX', 'STDY']
+
+    # Rough cost in seconds of extracting a whole frame at half scale.
+    COST = 0.045
+
+    # The quality tiers, each with its DIS preset, the Farneback pyramid
+    # levels, iterations and window size used without DIS and the rough cost
+    # in seconds of a whole frame at half scale.
+    TIERS = {
+        'ultrafast': {'PRESET': 'ULTRAFAST', 'LEVELS': 2, 'ITERATIONS': 2, 'WINSIZE': 9, 'COST': 0.002},
+        'fast': {'PRESET': 'FAST', 'LEVELS': 3, 'ITERATIONS': 3, 'WINSIZE': 11, 'COST': 0.003},
+        'accurate': {'PRESET': 'MEDIUM', 'LEVELS': 5, 'ITERATIONS': 10, 'WINSIZE': 13, 'COST': 0.010}
+    }
+
+    # Whether OpenCV has the DIS optical flow.
+    HAS_DIS = hasattr(cv2, 'DISOpticalFlow_create')
+
+    def __init__(self, init_frame, scale=1.0, tier=None):
+        # Factor by which every frame is resized before solving for the flow.
+        # Solving on a downscaled frame is much cheaper and the per-window
+        # statistics are still meaningful.
+        self.scale = scale
+
         # Parameters of the camera/images.
-        (r, c, _) = init_frame.shape
-        self.shape = (r, c)
-        self.prev_gray = cv2.cvtColor(init_frame, cv2.COLOR_BGR2GRAY)
+        init_gray = self.get_gray(init_frame)
+        self.shape = init_gray.shape
+        self.prev_gray = init_gray
 
         # Parameters for farneback optical flow.
         self.pyr_scale = 0.5   # next layer is twice smaller than the previous
@@ -37,26 +73,110 @@ class OpticalFlow(object):
         self.poly_sigma = 1.1  # standard deviation of the Gaussian used to smooth derivatives used as a basis for the polynomial expansion
         self.flags = 0         # no flags (OPTFLOW_USE_INITIAL_FLOW, OPTFLOW_FARNEBACK_GAUSSIAN)
 
+        # The original farneback parameters and the flow of the previous frame
+        # the next one starts from.
+        self.original = (self.levels, self.iterations, self.winsize)
+        self.flow = np.zeros(self.shape + (2,), dtype=np.float32)
+        self.set_tier(tier)
+
+    def set_tier(self, tier):
+        """ Switches to the given quality tier, or to the original
+            parameters if tier is None.
+        """
+        if tier is not None and tier not in self.TIERS:
+            raise ValueError("flow tier %s is not one of %s" % (tier, ', '.join(sorted(self.TIERS))))
+        self.tier = tier
+        self.dis = None
+        if tier is None:
+            (self.levels, self.iterations, self.winsize) = self.original
+        else:
+            params = self.TIERS[tier]
+            (self.levels, self.iterations, self.winsize) = (params['LEVELS'], params['ITERATIONS'], params['WINSIZE'])
+            if self.HAS_DIS:
+                self.dis = cv2.DISOpticalFlow_create(getattr(cv2, 'DISOPTICAL_FLOW_PRESET_' + params['PRESET']))
+        self.warm = False
+
+    def get_cost(self):
+        """ Returns the rough cost in seconds of a whole frame at half scale
+            at the current tier.
+        """
+        return self.COST if self.tier is None else self.TIERS[self.tier]['COST']
+
     def extract(self, frame):
         """ Extract optical flow from the current frame containing the
-            cartesian flow vectors for each pixel.
+            cartesian flow vectors for each pixel. With a tier the returned
+            flow is the buffer the next flow starts from, so it is only valid
+            until the next call.
         """
-        # Get the cv flow using farneback
-        cur_gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        out = np.copy(cur_gray)
-        flow = cv2.calcOpticalFlowFarneback(self.prev_gray,
-                                            cur_gray,
-                                            flow=out,
-                                            pyr_scale=self.pyr_scale,
-                                            levels=self.levels,
-                                            winsize=self.winsize,
-                                            iterations=self.iterations,
-                                            poly_n=self.poly_n,
-                                            poly_sigma=self.poly_sigma,
-                                            flags=self.flags)
+        cur_gray = self.get_gray(frame)
+        if self.tier is None:
+            # Solve from scratch with farneback.
+            flow = cv2.calcOpticalFlowFarneback(self.prev_gray, cur_gray, None,
+                                                pyr_scale=self.pyr_scale,
+                                                levels=self.levels,
+                                                winsize=self.winsize,
+                                                iterations=self.iterations,
+                                                poly_n=self.poly_n,
+                                                poly_sigma=self.poly_sigma,
+                                                flags=self.flags)
+            self.prev_gray = cur_gray
+            return flow
+
+        if self.flow.shape[0:2] != cur_gray.shape:
+            self.flow = np.zeros(cur_gray.shape + (2,), dtype=np.float32)
+            self.warm = False
+        if not self.warm:
+            self.flow[...] = 0
+        if self.dis is not None:
+            flow = self.dis.calc(self.prev_gray, cur_gray, self.flow)
+        else:
+            flow = cv2.calcOpticalFlowFarneback(self.prev_gray, cur_gray, self.flow,
+                                                pyr_scale=self.pyr_scale,
+                                                levels=self.levels,
+                                                winsize=self.winsize,
+                                                iterations=self.iterations,
+                                                poly_n=self.poly_n,
+                                                poly_sigma=self.poly_sigma,
+                                                flags=cv2.OPTFLOW_USE_INITIAL_FLOW if self.warm else 0)
+        self.flow = flow
+        self.warm = True
         self.prev_gray = cur_gray
         return flow
 
+    def set_prev(self, frame):
+        """ Makes the frame the one the next flow is solved against without
+            solving for the flow.
+        """
+        self.prev_gray = self.get_gray(frame)
+        self.warm = False
+
+    def config(self, tier=True):
+        """ Returns the parameters the features depend on, leaving out those
+            set by the quality tier if tier is False.
+        """
+        config = {
+            'SCALE': self.scale,
+            'PYR_SCALE': self.pyr_scale,
+            'POLY_N': self.poly_n,
+            'POLY_SIGMA': self.poly_sigma,
+            'FLAGS': self.flags
+        }
+        if tier:
+            config.update({
+                'TIER': self.tier,
+                'DIS': self.dis is not None,
+                'LEVELS': self.levels,
+                'WINSIZE': self.winsize,
+                'ITERATIONS': self.iterations
+            })
+        return config
+
+    def get_gray(self, frame):
+        """ Returns the (optionally downscaled) gray image of the frame the
+            flow is solved on.
+        """
+        return prepare(frame).get_gray(self.scale)
+
     @staticmethod
     def get_image(flow):
         """ Extracts a viewable image from the flow matrix.
@@ -108,6 +228,20 @@ class OpticalFlow(object):
         features[indices['STDY']] = np.std(flow_y)
         return features
 
+    @staticmethod
+    def get_window_features(flow, pool):
+        """ Extracts the same features as get_features for every window of a
+            whole frame flow matrix at once using a window pool. Returns an
+            array with one row of features per window.
+        """
+        (flow_mag, _) = cv2.cartToPolar(flow[..., 0], flow[..., 1])
+        features = np.zeros((pool.size, 5))
+        (features[:, 0], features[:, 1]) = pool.extrema(flow_mag)
+        features[:, 2] = pool.mean(flow_mag)
+        (_, features[:, 3]) = pool.mean_std(np.ascontiguousarray(flow[..., 0]))
+        (_, features[:, 4]) = pool.mean_std(np.ascontiguousarray(flow[..., 1]))
+        return features
+
 
 def _test_optical_flow():
     pdb.set_trace()
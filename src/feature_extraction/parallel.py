@@ -0,0 +1,120 @@
+#!/usr/bin/env python2.7
+
+""" Spreads the visual feature extractors over a pool of processes.
+"""
+
+import ctypes
+import multiprocessing
+import traceback
+import numpy as np
+
+
+# The shared memory type of each feature dtype.
+CTYPES = {'float32': ctypes.c_float, 'float64': ctypes.c_double}
+
+
+class ParallelExtractor(object):
+    """ Extracts the visual feature blocks in a pool of processes.
+
+        Each process owns a fixed partition of the visual blocks (the
+        extractors) for its whole life, so extractor state such as the
+        previous frame of the optical flow always stays in the same process.
+        The processes are forked from the feature extractor and extract with
+        their own copy of it. Frames are handed over by copying them into a
+        shared memory buffer and the processes write their features straight
+        into a shared memory feature row, so neither is ever pickled. Only a
+        short message goes through each process's pipe per frame, along with
+        the odd message switching the quality tier of the flow.
+
+        All frames must have the shape of the initial image.
+
+        Forking only copies the thread that forks, so a lock another thread
+        holds at that moment stays held in the processes. The processes only
+        use their extractors, numpy and OpenCV, so threads already running
+        must not be inside OpenCV while the extractor is created. When
+        flying, the extractor is created after the drone's camera thread
+        starts decoding, which is why FlyTool.EXTRACTION_PROCESSES is zero
+        by default.
+    """
+    def __init__(self, extractor, processes):
+        self.layout = extractor.layout
+        self.shape = extractor.init_image.shape
+
+        # Shared memory for the frame and the features.
+        self.frame_array = multiprocessing.RawArray(ctypes.c_uint8, int(np.prod(self.shape)))
+        self.frame = np.frombuffer(self.frame_array, dtype=np.uint8).reshape(self.shape)
+        self.feats_array = multiprocessing.RawArray(CTYPES[self.layout.dtype.name], self.layout.size)
+        self.feats = np.frombuffer(self.feats_array, dtype=self.layout.dtype).reshape((1, self.layout.size))
+        np.copyto(self.feats, extractor.last_feats)
+
+        # Deal the blocks out to the processes, most expensive first.
+        blocks = extractor.priority
+        self.partitions = [[] for i in range(0, max(1, min(processes, len(blocks))))]
+        for (i, name) in enumerate(blocks):
+            self.partitions[i % len(self.partitions)].append(name)
+
+        # Start a process for each partition.
+        self.pipes = []
+        self.processes = []
+        for partition in self.partitions:
+            (pipe, child_pipe) = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=serve, args=(extractor, partition, self.frame_array, self.feats_array, self.shape, child_pipe))
+            process.daemon = True
+            process.start()
+            self.pipes.append(pipe)
+            self.processes.append(process)
+
+    def get_visual_features(self, image, feats):
+        """ Extracts the visual features of the image in the processes and
+            writes them into the feature row.
+        """
+        image = getattr(image, 'image', image)
+        if image.shape != self.shape:
+            raise ValueError('frame shape %s does not match the initial shape %s' % (image.shape, self.shape))
+        np.copyto(self.frame, image)
+
+        # Start every process before waiting on any of them.
+        for pipe in self.pipes:
+            pipe.send(True)
+        errors = [pipe.recv() for pipe in self.pipes]
+        errors = [e for e in errors if e is not None]
+        if errors:
+            raise RuntimeError('feature extraction process failed:\n%s' % '\n'.join(errors))
+
+        for partition in self.partitions:
+            for name in partition:
+                feats[0, self.layout.slices[name]] = self.feats[0, self.layout.slices[name]]
+        return feats
+
+    def set_flow_tier(self, tier):
+        """ Switches the quality tier of the flow in every process before
+            the next frame.
+        """
+        for pipe in self.pipes:
+            pipe.send(('TIER', tier))
+
+    def stop(self):
+        for pipe in self.pipes:
+            pipe.send(None)
+        for process in self.processes:
+            process.join()
+
+
+def serve(extractor, blocks, frame_array, feats_array, shape, pipe):
+    """ Extracts the given blocks of every frame written to the shared frame
+        until told to stop. Runs in the extraction processes.
+    """
+    frame = np.frombuffer(frame_array, dtype=np.uint8).reshape(shape)
+    feats = np.frombuffer(feats_array, dtype=extractor.layout.dtype).reshape((1, -1))
+    while True:
+        message = pipe.recv()
+        if message is None:
+            break
+        if isinstance(message, tuple):
+            extractor.apply_flow_tier(message[1])
+            continue
+        try:
+            extractor.get_visual_features(frame, feats, blocks)
+            pipe.send(None)
+        except Exception:
+            pipe.send(traceback.format_exc())
@@ -0,0 +1,122 @@
+#!/usr/bin/env python2.7
+
+""" Pools per-pixel feature maps over the windows of a frame.
+"""
+
+import numpy as np
+import cv2
+
+
+class WindowPool(object):
+    """ Computes window statistics of per-pixel maps using summed area tables.
+
+        The integral images (sum and sum of squares) of a map are built once
+        per frame after which the mean and standard deviation of every window
+        in the grid, including the overlapping ones, are found with four
+        lookups each in a single vectorized call. The cost per window is
+        therefore constant no matter the window size or overlap.
+
+        Windows are given in the same form returned by get_windows and are
+        flattened in row major order, the same order the feature extractor
+        stacks its window features in.
+    """
+    def __init__(self, windows, shape, scale=1.0):
+        (rows, cols) = shape[0:2]
+        self.shape = (rows, cols)
+
+        # Flatten the windows and scale them to the map they will pool.
+        bounds = np.array([w for row in windows for w in row], dtype=np.float64)
+        x_start = np.floor(bounds[:, 0]*scale).astype(np.intp)
+        y_start = np.floor(bounds[:, 2]*scale).astype(np.intp)
+        x_end = np.ceil(bounds[:, 1]*scale).astype(np.intp)
+        y_end = np.ceil(bounds[:, 3]*scale).astype(np.intp)
+
+        # Clip the windows to the map making sure none of them end up empty.
+        self.x_start = np.clip(x_start, 0, cols - 1)
+        self.y_start = np.clip(y_start, 0, rows - 1)
+        self.x_end = np.clip(np.maximum(x_end, self.x_start + 1), 1, cols)
+        self.y_end = np.clip(np.maximum(y_end, self.y_start + 1), 1, rows)
+        self.area = ((self.x_end - self.x_start)*(self.y_end - self.y_start)).astype(np.float64)
+        self.size = self.area.shape[0]
+
+    def slices(self):
+        """ Returns the (row, col) slices of each window into the map.
+        """
+        return [(slice(self.y_start[i], self.y_end[i]), slice(self.x_start[i], self.x_end[i])) for i in range(0, self.size)]
+
+    def crop(self, indices, margin=0):
+        """ Returns the (row, col) slices of the smallest part of the map
+            holding the given windows grown by margin on every side, along
+            with a window pool of just those windows in that part of the map.
+        """
+        (rows, cols) = self.shape
+        y0 = max(np.min(self.y_start[indices]) - margin, 0)
+        x0 = max(np.min(self.x_start[indices]) - margin, 0)
+        y1 = min(np.max(self.y_end[indices]) + margin, rows)
+        x1 = min(np.max(self.x_end[indices]) + margin, cols)
+        windows = [[(self.x_start[i] - x0, self.x_end[i] - x0, self.y_start[i] - y0, self.y_end[i] - y0) for i in indices]]
+        return ((slice(y0, y1), slice(x0, x1)), WindowPool(windows, (y1 - y0, x1 - x0)))
+
+    def select(self, indices):
+        """ Returns a window pool of just the given windows of the same map.
+        """
+        windows = [[(self.x_start[i], self.x_end[i], self.y_start[i], self.y_end[i]) for i in indices]]
+        return WindowPool(windows, self.shape)
+
+    def lookup(self, table):
+        """ Sums every window from the summed area table of a map.
+        """
+        return (table[self.y_end, self.x_end] - table[self.y_start, self.x_end] -
+                table[self.y_end, self.x_start] + table[self.y_start, self.x_start])
+
+    def mean(self, image):
+        """ Returns the mean of the map over each window.
+        """
+        table = cv2.integral(image, sdepth=cv2.CV_64F)
+        return self.lookup(table)/self.area
+
+    def mean_std(self, image):
+        """ Returns the mean and the standard deviation of the map over each
+            window.
+        """
+        (table, sq_table) = cv2.integral2(image, sdepth=cv2.CV_64F, sqdepth=cv2.CV_64F)
+        mean = self.lookup(table)/self.area
+        var = self.lookup(sq_table)/self.area - mean**2
+        return (mean, np.sqrt(np.maximum(var, 0)))
+
+    def extrema(self, image):
+        """ Returns the minimum and the maximum of the map over each window.
+
+            Extrema can not be found from summed area tables so these cost a
+            reduction over each window.
+        """
+        mins = np.empty(self.size)
+        maxs = np.empty(self.size)
+        for (i, (rows, cols)) in enumerate(self.slices()):
+            (mins[i], maxs[i], _, _) = cv2.minMaxLoc(image[rows, cols])
+        return (mins, maxs)
+
+
+def _test_window_pool():
+    # Make sure the pooled statistics match those computed on each window.
+    import feature_extractor
+    test_image = cv2.imread('../../samples/test_forest.jpg')
+    gray = cv2.cvtColor(test_image, cv2.COLOR_BGR2GRAY).astype(np.float32)
+    windows = feature_extractor.get_windows(test_image, (10, 5), 0.25)
+    pool = WindowPool(windows, gray.shape)
+    (mean, std) = pool.mean_std(gray)
+    (mins, maxs) = pool.extrema(gray)
+    for (i, (rows, cols)) in enumerate(pool.slices()):
+        window = gray[rows, cols]
+        assert np.allclose(mean[i], np.mean(window))
+        assert np.allclose(std[i], np.std(window), atol=1e-3)
+        assert mins[i] == np.min(window) and maxs[i] == np.max(window)
+
+    # Selected windows pool the same as in the whole grid.
+    selected = pool.select([3, 17, 42])
+    assert np.allclose(selected.mean(gray), mean[[3, 17, 42]])
+    print('Success.')
+
+
+if __name__ == '__main__':
+    _test_window_pool()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python2.7
+
+""" Per-frame cache of the images derived from a camera frame.
+"""
+
+import hashlib
+import numpy as np
+import cv2
+
+
+class PreparedFrame(object):
+    """ A camera frame along with the images derived from it.
+
+        Every derived image (gray, YCrCb, HSV, Canny edges and downscaled gray
+        images) is computed the first time it is asked for and memoized, so
+        however many feature extractors and trackers consume the frame each
+        conversion happens at most once. So is the hash of the frame's
+        content, which identifies the frame in the feature cache.
+    """
+    def __init__(self, image):
+        self.image = image
+        self.shape = image.shape
+        self.cache = {}
+
+    def get_gray(self, scale=1.0):
+        """ Returns the gray image, downscaled by scale if given.
+        """
+        key = ('GRAY', scale)
+        if key not in self.cache:
+            if scale == 1.0:
+                self.cache[key] = cv2.cvtColor(self.image, cv2.COLOR_BGR2GRAY)
+            else:
+                self.cache[key] = cv2.resize(self.get_gray(), (0, 0), fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        return self.cache[key]
+
+    def get_hash(self):
+        """ Returns the SHA-1 hash of the frame's shape and pixels.
+        """
+        if 'HASH' not in self.cache:
+            sha = hashlib.sha1(str(self.image.shape))
+            sha.update(np.ascontiguousarray(self.image).data)
+            self.cache['HASH'] = sha.hexdigest()
+        return self.cache['HASH']
+
+    def get_ycrcb(self):
+        """ Returns the image in the YCrCb color space.
+        """
+        if 'YCRCB' not in self.cache:
+            self.cache['YCRCB'] = cv2.cvtColor(self.image, cv2.COLOR_BGR2YCrCb)
+        return self.cache['YCRCB']
+
+    def get_hsv(self):
+        """ Returns the image in the HSV color space.
+        """
+        if 'HSV' not in self.cache:
+            self.cache['HSV'] = cv2.cvtColor(self.image, cv2.COLOR_BGR2HSV)
+        return self.cache['HSV']
+
+    def get_edges(self, thresh1, thresh2, aperture_size=3):
+        """ Returns the Canny edges of the gray image.
+        """
+        key = ('EDGES', thresh1, thresh2, aperture_size)
+        if key not in self.cache:
+            self.cache[key] = cv2.Canny(self.get_gray(), thresh1, thresh2, apertureSize=aperture_size)
+        return self.cache[key]
+
+
+def prepare(image):
+    """ Wraps a raw BGR image in a prepared frame, passing prepared frames
+        through untouched.
+    """
+    if isinstance(image, PreparedFrame):
+        return image
+    return PreparedFrame(image)
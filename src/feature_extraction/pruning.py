@@ -0,0 +1,127 @@
+#!/usr/bin/env python2.7
+
+""" Pruning of the features a linear model barely weighs.
+"""
+
+import json
+import numpy as np
+
+from layout import FeatureLayout
+
+
+class PruningPlan(object):
+    """ The cells (windows, angles) of each visual block worth extracting for
+        a linear model.
+
+        Pruned cells are not extracted and their features are filled in with
+        their mean over the training data instead. Filling a column j in with
+        its mean m_j changes the prediction by w_j*(x_j - m_j), so over the
+        training data the prediction changes by at most the bound
+
+            sum over pruned columns j of |w_j|*max |x_j - m_j|.
+
+        Cells are pruned from the one contributing the least to the bound up
+        until the bound would exceed the tolerance, so predictions on data
+        like the training data are within tolerance of the full ones. A block
+        none of whose cells are kept is not extracted at all. The history
+        blocks are always kept as they cost next to nothing.
+    """
+    # The blocks that can be pruned.
+    PRUNABLE_BLOCKS = ['flow', 'laws', 'hough', 'orientation', 'radon']
+
+    def __init__(self, blocks, keep, fill, tolerance, bound):
+        self.blocks = blocks
+        self.keep = keep
+        self.fill = np.asarray(fill, dtype=np.float64)
+        self.tolerance = tolerance
+        self.bound = bound
+
+    @staticmethod
+    def build(layout, coef, features, tolerance):
+        """ Builds the plan of a feature layout from the weights of a linear
+            model and the training features, both with one entry per column
+            of the layout.
+        """
+        coef = np.ravel(coef)
+        if coef.shape[0] != layout.size or features.shape[1] != layout.size:
+            raise ValueError('model has %s weights and %s features but the layout has %s columns' % (coef.shape[0], features.shape[1], layout.size))
+        fill = np.mean(features, 0)
+        spread = np.max(np.abs(features - fill), 0)
+        contributions = np.abs(coef)*spread
+
+        # The contribution of every cell of the prunable blocks.
+        cells = []
+        for block in layout.blocks:
+            if block['NAME'] not in PruningPlan.PRUNABLE_BLOCKS:
+                continue
+            cell_contributions = layout.get_view(contributions[np.newaxis, :], block['NAME']).sum(1)
+            cells += [(c, block['NAME'], i) for (i, c) in enumerate(cell_contributions)]
+
+        keep = dict((block['NAME'], range(0, block['COUNT'])) for block in layout.blocks)
+        bound = 0.0
+        for (c, name, i) in sorted(cells):
+            if bound + c > tolerance:
+                break
+            bound += c
+            keep[name].remove(i)
+        return PruningPlan(layout.blocks, keep, fill, tolerance, bound)
+
+    def check(self, layout):
+        """ Makes sure the plan was built for the given layout.
+        """
+        if not FeatureLayout(self.blocks).matches(layout):
+            raise ValueError('pruning plan was built for a different feature layout')
+
+    def get_kept(self, name, count):
+        """ Returns a mask of the cells of the block that are kept.
+        """
+        kept = np.zeros(count, dtype=bool)
+        kept[self.keep[name]] = True
+        return kept
+
+    def get_fraction(self):
+        """ Returns the fraction of the cells of the prunable blocks kept.
+            This is not the fraction of the extraction time, as the flow
+            field, Hough lines and radon transform are still computed over
+            the whole frame while any of their cells is kept.
+        """
+        blocks = [b for b in self.blocks if b['NAME'] in self.PRUNABLE_BLOCKS]
+        return float(sum(len(self.keep[b['NAME']]) for b in blocks))/max(sum(b['COUNT'] for b in blocks), 1)
+
+    def save(self, filename):
+        with open(filename, 'w') as f:
+            json.dump({
+                'BLOCKS': self.blocks,
+                'KEEP': self.keep,
+                'FILL': self.fill.tolist(),
+                'TOLERANCE': self.tolerance,
+                'BOUND': self.bound
+            }, f)
+
+    @staticmethod
+    def load(filename):
+        with open(filename, 'r') as f:
+            plan = json.load(f)
+        return PruningPlan(plan['BLOCKS'], plan['KEEP'], plan['FILL'], plan['TOLERANCE'], plan['BOUND'])
+
+
+def _test_pruning_plan():
+    # Make sure pruned predictions stay within the bound.
+    layout = FeatureLayout()
+    layout.add_block('flow', ['MIN', 'MAX'], 10)
+    layout.add_block('cmd_history', ['X'], 3)
+    features = np.random.randn(200, layout.size)
+    coef = np.random.randn(layout.size)*np.logspace(-3, 0, layout.size)
+    plan = PruningPlan.build(layout, coef, features, 0.5)
+    assert plan.bound <= 0.5 and len(plan.keep['flow']) < 10
+    assert plan.keep['cmd_history'] == [0, 1, 2]
+
+    kept = np.repeat(plan.get_kept('flow', 10), 2)
+    pruned = features.copy()
+    pruned[:, 0:20][:, ~kept] = plan.fill[0:20][~kept]
+    assert np.max(np.abs(np.dot(pruned - features, coef))) <= plan.bound + 1e-9
+    print('Success.')
+
+
+if __name__ == '__main__':
+    _test_pruning_plan()
@@ -3,47 +3,119 @@
 """ Extracts the radon transform features from the drone.
 """
 
-import traceback
 import numpy as np
 import cv2
-from skimage.io import imread
-from skimage import data_dir
-from skimage.transform import radon, rescale
+
+from prepared_frame import prepare
 
 
 class RadonTransform(object):
     """ Extracts radon transform features.
+
+        The transform is taken of the gradient magnitude of the gray frame
+        downscaled by scale, over a fixed set of NUM_ANGLES angles spread
+        evenly over 180 degrees. Each projection is binned into NUM_BINS bins
+        across the frame, so the sinogram is already the compact
+        NUM_ANGLES x NUM_BINS feature block. The bin each pixel falls into at
+        each angle only depends on the shape of the frame and is computed
+        once, so the transform is a single weighted bincount per frame. Each
+        bin holds the mean gradient magnitude of the pixels projected into
+        it, so bins cut short by the corners of the frame are not weaker.
     """
-    def __init__(self, image):
-        self.theta = np.linspace(0.0, 180.0, max(image.shape), endpoint=False)
-        
+    NUM_ANGLES = 12
+    NUM_BINS = 16
+
+    # Names of the features of each angle in order.
+    FEATURES = ['BIN%d' % i for i in range(NUM_BINS)]
+
+    # Expected extraction time of a frame in seconds.
+    COST = 0.003
+
+    def __init__(self, image, scale=0.25):
+        self.scale = scale
+        self.theta = np.linspace(0.0, 180.0, self.NUM_ANGLES, endpoint=False)
+        self.shape = None
+        self.init_projection(prepare(image).get_gray(self.scale).shape)
+
+    def init_projection(self, shape):
+        """ Precomputes the sinogram bin of every pixel at every angle for
+            downscaled frames of the given shape.
+        """
+        (h, w) = shape[0:2]
+        self.shape = (h, w)
+        (y, x) = np.mgrid[0:h, 0:w]
+        x = x.ravel() - (w - 1)/2.
+        y = y.ravel() - (h - 1)/2.
+        radius = np.hypot(w, h)/2.
+
+        # Distance of each pixel along the normal of each angle, binned.
+        angles = np.deg2rad(self.theta)[:, np.newaxis]
+        t = x*np.cos(angles) + y*np.sin(angles)
+        bins = np.floor((t + radius)*self.NUM_BINS/(2*radius)).astype(np.intp)
+        bins = np.clip(bins, 0, self.NUM_BINS - 1)
+
+        # Offset the bins of each angle so all of them can be counted at once.
+        self.indices = (bins + self.NUM_BINS*np.arange(self.NUM_ANGLES)[:, np.newaxis]).ravel()
+        counts = np.bincount(self.indices, minlength=self.NUM_ANGLES*self.NUM_BINS)
+        self.counts = np.maximum(counts, 1).reshape((self.NUM_ANGLES, self.NUM_BINS))
+        self.weights = np.zeros((self.NUM_ANGLES, h*w))
+
+    def config(self):
+        """ Returns the parameters the features depend on.
+        """
+        return {'SCALE': self.scale, 'NUM_ANGLES': self.NUM_ANGLES, 'NUM_BINS': self.NUM_BINS}
+
     def extract(self, image):
-        """ Applies the radon transform to the image.
+        """ Applies the radon transform to the image and returns the binned
+            sinogram with one row per angle.
         """
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        try:
-            sinogram = radon(gray, theta=self.theta, circle=False)
-        except:
-            print(traceback.format_exc())
-        return sinogram
+        gray = prepare(image).get_gray(self.scale)
+        if gray.shape[0:2] != self.shape:
+            self.init_projection(gray.shape)
+
+        dx = cv2.Sobel(gray, cv2.CV_32F, 1, 0)
+        dy = cv2.Sobel(gray, cv2.CV_32F, 0, 1)
+        magnitude = cv2.magnitude(dx, dy)
+
+        # Every pixel contributes to one bin per angle.
+        self.weights[...] = magnitude.ravel()
+        sinogram = np.bincount(self.indices, weights=self.weights.ravel(), minlength=self.NUM_ANGLES*self.NUM_BINS)
+        return sinogram.reshape((self.NUM_ANGLES, self.NUM_BINS))/self.counts
 
     @staticmethod
     def get_features(sinogram):
         """ Computes features from the sinogram found by the radon transform
-            extractor.
+            extractor, one column per angle and bin.
         """
-        # Descritize the matrix into 15 by 15 bins.
+        return np.reshape(sinogram, (-1, 1))
 
 
 def _test_radon_transform():
-    pdb.set_trace()
+    import time
     test_filename = './../../samples/test_forest.jpg'
 
-    image = cv2.imread(test_filename, cv2.CV_LOAD_IMAGE_COLOR)
+    image = cv2.imread(test_filename)
     radon_transform = RadonTransform(image)
     sinogram = radon_transform.extract(image)
+    assert sinogram.shape == (RadonTransform.NUM_ANGLES, RadonTransform.NUM_BINS)
+
+    # A horizontal edge only shows up in a single bin of the vertical
+    # projection.
+    edge = np.zeros((200, 200, 3), dtype=np.uint8)
+    edge[100:, :] = 255
+    radon_transform = RadonTransform(edge, scale=1.0)
+    sinogram = radon_transform.extract(edge)
+    vertical = RadonTransform.NUM_ANGLES//2
+    assert np.argmax(sinogram[vertical]) in (RadonTransform.NUM_BINS//2 - 1, RadonTransform.NUM_BINS//2)
+    assert np.count_nonzero(sinogram[vertical] > 1e-3) <= 2
+
+    radon_transform = RadonTransform(image)
+    start_time = time.time()
+    for i in range(0, 100):
+        RadonTransform.get_features(radon_transform.extract(image))
+    print('%.2f ms per frame' % ((time.time() - start_time)*10))
+    print('Success.')
 
 
 if __name__ == '__main__':
-    import pdb
     _test_radon_transform()
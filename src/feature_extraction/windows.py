@@ -0,0 +1,233 @@
+#!/usr/bin/env python2.7
+
+""" Memoized plans of the windows an image is descritized into.
+"""
+
+import json
+import math
+import os.path
+import numpy as np
+import cv2
+
+import pooling
+
+
+class WindowSpec(object):
+    """ Layout of the windows of a frame, independent of its shape.
+
+        The frame is cut into a grid whose columns and rows are given as
+        whole numbers of grid units, so the grid can be finer in some places
+        than others: a frame w pixels wide is cut into columns of
+        columns[c]*(w//sum(columns)) pixels and likewise for the rows. Each
+        window grows by overlap/4 of its size on every side into its
+        neighbours. Masked cells, given by row and column, have no window
+        (such as a band of sky that says nothing about obstacles), and the
+        windows of the other cells are numbered in row major order.
+
+        The uniform grid of window_size (columns, rows) windows used before
+        window specs is the spec with one unit per column and row and nothing
+        masked, which gives exactly the same windows.
+    """
+    def __init__(self, columns, rows, overlap, masked=()):
+        self.columns = [int(c) for c in columns]
+        self.rows = [int(r) for r in rows]
+        self.overlap = overlap
+        self.masked = sorted([int(r), int(c)] for (r, c) in masked)
+        if not self.columns or not self.rows or min(self.columns + self.rows) < 1:
+            raise ValueError('window grid columns %s and rows %s must be whole numbers of units' % (self.columns, self.rows))
+        for (r, c) in self.masked:
+            if not (0 <= r < len(self.rows) and 0 <= c < len(self.columns)):
+                raise ValueError('masked cell (%s, %s) is not in the %sx%s window grid' % (r, c, len(self.rows), len(self.columns)))
+
+        # The (row, column) of every window in order.
+        masked = set(tuple(m) for m in self.masked)
+        self.cells = [(r, c) for r in range(0, len(self.rows)) for c in range(0, len(self.columns)) if (r, c) not in masked]
+        self.size = len(self.cells)
+        self.window_size = (len(self.columns), len(self.rows))
+
+    @staticmethod
+    def uniform(window_size, overlap):
+        """ Returns the spec of a uniform grid of window_size (columns, rows)
+            windows.
+        """
+        return WindowSpec([1]*window_size[0], [1]*window_size[1], overlap)
+
+    def is_uniform(self):
+        """ Returns whether every window has the same size.
+        """
+        return set(self.columns) == set([1]) and set(self.rows) == set([1]) and not self.masked
+
+    def get_edges(self, length, units):
+        """ Returns the pixel edges of the cells along one side of the frame.
+        """
+        unit = length//sum(units)
+        edges = [0]
+        for u in units:
+            edges.append(edges[-1] + u*unit)
+        return edges
+
+    def config(self):
+        return {
+            'COLUMNS': self.columns,
+            'ROWS': self.rows,
+            'OVERLAP': self.overlap,
+            'MASKED': self.masked
+        }
+
+    def key(self):
+        """ Returns a hashable key of the spec.
+        """
+        return json.dumps(self.config(), sort_keys=True)
+
+    def save(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.config(), f)
+
+    @staticmethod
+    def from_config(config):
+        return WindowSpec(config['COLUMNS'], config['ROWS'], config['OVERLAP'], config.get('MASKED', []))
+
+    @staticmethod
+    def load(filename):
+        with open(filename, 'r') as f:
+            return WindowSpec.from_config(json.load(f))
+
+
+# Named window specs. The uniform grid is the one flown before window specs.
+# The foveated grid has cells a third of the width of the uniform ones
+# across the middle of the frame and a bit over half the height along the
+# horizon, coarse cells towards the edges and no windows in the band of sky
+# along the top, for 32 windows instead of 50.
+PRESETS = {
+    'uniform': WindowSpec.uniform((10, 5), 0.25),
+    'foveated': WindowSpec([4, 2, 1, 1, 1, 1, 2, 4], [3, 1, 1, 1, 2], 0.25, [[0, c] for c in range(0, 8)])
+}
+
+
+def get_spec(window_size, overlap=None):
+    """ Returns the window spec given either as a spec, its configuration,
+        the name of a preset, a JSON file holding its configuration or the
+        (columns, rows) of a uniform grid with the given overlap.
+    """
+    if isinstance(window_size, WindowSpec):
+        return window_size
+    if isinstance(window_size, dict):
+        return WindowSpec.from_config(window_size)
+    if isinstance(window_size, basestring):
+        if window_size in PRESETS:
+            return PRESETS[window_size]
+        if os.path.isfile(window_size):
+            return WindowSpec.load(window_size)
+        raise ValueError('window spec %s is neither one of %s nor a file' % (window_size, ', '.join(sorted(PRESETS))))
+    return WindowSpec.uniform(window_size, overlap)
+
+
+class WindowPlan(object):
+    """ Precomputed windows of frames of a given shape.
+
+        Holds the windows of the window spec, one list per row of the grid
+        in the form returned by get_windows, their slices into the frame in
+        row major order and the window pools of the maps derived from the
+        frame. If the grid is uniform the frame can also be padded by the
+        overlap on every side so that every window, including the border
+        windows, has the same size, in which case the whole set of windows
+        is exposed as a single strided view without copying or resizing any
+        of them.
+    """
+    def __init__(self, shape, spec):
+        (y, x) = shape[0:2]
+        self.shape = tuple(shape)
+        self.spec = spec
+        self.window_size = spec.window_size
+        self.size = spec.size
+
+        # The edges of the cells and the overlap of the windows of each
+        # column and row.
+        x_edges = spec.get_edges(x, spec.columns)
+        y_edges = spec.get_edges(y, spec.rows)
+        x_overlap = [int(math.floor((x_edges[c + 1] - x_edges[c])*spec.overlap/4)) for c in range(0, len(spec.columns))]
+        y_overlap = [int(math.floor((y_edges[r + 1] - y_edges[r])*spec.overlap/4)) for r in range(0, len(spec.rows))]
+
+        # Matrix that will hold the window sizes.
+        self.windows = [[] for z in range(0, len(spec.rows))]
+        for (r, c) in spec.cells:
+            x_start = x_edges[c] - x_overlap[c]
+            x_end   = x_edges[c + 1] + x_overlap[c]
+            y_start = y_edges[r] - y_overlap[r]
+            y_end   = y_edges[r + 1] + y_overlap[r]
+            self.windows[r].append((max(x_start, 0), max(x_end, 0), max(y_start, 0), max(y_end, 0)))
+        self.slices = [(slice(w[2], w[3]), slice(w[0], w[1])) for row in self.windows for w in row]
+
+        # The size of the windows of a uniform grid and the shape all of them
+        # have once the frame is padded.
+        if spec.is_uniform():
+            self.length = (x_edges[1], y_edges[1])
+            self.overlap = (x_overlap[0], y_overlap[0])
+            self.window_shape = (self.length[1] + 2*self.overlap[1], self.length[0] + 2*self.overlap[0])
+
+        self.pools = {}
+
+    def get_pool(self, shape, scale=1.0):
+        """ Returns the window pool for maps of the given shape derived from
+            the frame scaled by scale, building it the first time.
+        """
+        key = (tuple(shape[0:2]), scale)
+        if key not in self.pools:
+            self.pools[key] = pooling.WindowPool(self.windows, shape, scale)
+        return self.pools[key]
+
+    def get_views(self, image):
+        """ Pads the image by the overlap and returns a strided view of it
+            holding every (equal sized) window, indexed by row and column of
+            the window first. Only uniform grids have such a view.
+        """
+        if not self.spec.is_uniform():
+            raise ValueError('only uniform window grids have equal sized windows')
+        (ox, oy) = self.overlap
+        padded = cv2.copyMakeBorder(image, oy, oy, ox, ox, cv2.BORDER_REFLECT_101)
+        strides = padded.strides
+        shape = (self.window_size[1], self.window_size[0]) + self.window_shape + padded.shape[2:]
+        strides = (self.length[1]*strides[0], self.length[0]*strides[1]) + strides
+        return np.lib.stride_tricks.as_strided(padded, shape=shape, strides=strides)
+
+
+# Plans already built keyed by (frame shape, window spec).
+_plans = {}
+
+
+def get_plan(shape, window_size, percent_overlap=None):
+    """ Returns the window plan for frames of the given shape, building it
+        the first time it is asked for. The windows are given by a window
+        spec or anything else get_spec takes.
+    """
+    spec = get_spec(window_size, percent_overlap)
+    key = (tuple(shape), spec.key())
+    if key not in _plans:
+        _plans[key] = WindowPlan(shape, spec)
+    return _plans[key]
+
+
+def _test_window_plan():
+    # Make sure the windows match those of the padded views.
+    test_image = cv2.imread('../../samples/test_forest.jpg')
+    plan = get_plan(test_image.shape, (10, 5), 0.25)
+    assert plan is get_plan(test_image.shape, (10, 5), 0.25)
+    views = plan.get_views(test_image)
+    (ox, oy) = plan.overlap
+    for r in range(1, 4):
+        for c in range(1, 9):
+            (x_start, x_end, y_start, y_end) = plan.windows[r][c]
+            assert views[r, c].shape[0:2] == plan.window_shape
+            assert np.array_equal(views[r, c], test_image[y_start:y_end, x_start:x_end])
+
+    # The foveated grid has finer windows in the middle and none in the sky.
+    plan = get_plan(test_image.shape, 'foveated')
+    assert plan.size == 32 and len(plan.windows[0]) == 0 and len(plan.slices) == 32
+    widths = [w[1] - w[0] for w in plan.windows[2]]
+    assert widths[3] < widths[1] < widths[0]
+    assert plan is get_plan(test_image.shape, WindowSpec.from_config(plan.spec.config()))
+    print('Success.')
+
+
+if __name__ == '__main__':
+    _test_window_plan()
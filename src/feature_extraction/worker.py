@@ -0,0 +1,136 @@
+#!/usr/bin/env python2.7
+
+""" Long-lived feature extraction worker.
+"""
+
+import threading
+import time
+import traceback
+
+
+class ExtractionWorker(threading.Thread):
+    """ Extracts features from submitted frames in a single long-lived
+        thread.
+
+        Frames are submitted with submit, which returns the sequence number
+        given to the frame, and their results are fetched with get_result,
+        which can wait for a given sequence number with a timeout. At most one
+        frame waits while another one is being extracted. When a frame is
+        submitted while one is already waiting, the drop policy decides which
+        of the two is dropped: 'drop-oldest' replaces the waiting frame with
+        the new one while 'drop-newest' keeps the waiting frame and rejects
+        the new one.
+
+        The extraction function returns a dictionary holding the features of
+        the frame (FEATURES) and anything else it reports. Each result is that
+        dictionary along with the sequence number of the frame (SEQ), the time
+        the frame waited before being extracted (QUEUE_DELAY) and the time
+        taken to extract it (EXTRACT_TIME). The sequence number of the frame
+        being extracted is kept in extracting while it is. If extracting a
+        frame raises, its result holds the traceback (ERROR) instead and the
+        worker carries on with the next frame.
+
+        A frame can be submitted along with a reference to the frame buffer
+        holding it (see camera.FramePool), which is released once the frame
+        has been extracted or dropped.
+    """
+    DROP_POLICIES = ('drop-oldest', 'drop-newest')
+
+    def __init__(self, extract_func, drop_policy='drop-oldest'):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        if drop_policy not in self.DROP_POLICIES:
+            raise ValueError("drop policy %s is not 'drop-oldest' or 'drop-newest'" % drop_policy)
+        self.extract_func = extract_func
+        self.drop_policy = drop_policy
+
+        self.condition = threading.Condition()
+        self.pending = None
+        self.result = None
+        self.running = True
+        self.extracting = None
+
+        # Counters for measuring the worker.
+        self.seq = 0
+        self.submitted = 0
+        self.dropped = 0
+        self.completed = 0
+
+    def submit(self, image, frame_buffer=None):
+        """ Submits a frame for extraction and returns its sequence number,
+            or None if the frame was dropped.
+        """
+        with self.condition:
+            self.submitted += 1
+            if self.pending is not None:
+                self.dropped += 1
+                if self.drop_policy == 'drop-newest':
+                    release(frame_buffer)
+                    return None
+                release(self.pending[3])
+            self.seq += 1
+            self.pending = (self.seq, image, time.time(), frame_buffer)
+            self.condition.notify_all()
+            return self.seq
+
+    def get_result(self, seq=None, timeout=None):
+        """ Returns the newest result not yet fetched whose sequence number is
+            at least seq, waiting at most timeout seconds for it (forever if
+            timeout is None). Returns None if there is no such result in time.
+        """
+        with self.condition:
+            deadline = None if timeout is None else time.time() + timeout
+            while not self.is_ready(seq):
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+            (result, self.result) = (self.result, None)
+            return result
+
+    def is_ready(self, seq):
+        return self.result is not None and (seq is None or self.result['SEQ'] >= seq)
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            if self.pending is not None:
+                release(self.pending[3])
+                self.pending = None
+            self.condition.notify_all()
+
+    def run(self):
+        while True:
+            # Wait for the next frame.
+            with self.condition:
+                while self.running and self.pending is None:
+                    self.condition.wait()
+                if not self.running:
+                    break
+                ((seq, image, submit_time, frame_buffer), self.pending) = (self.pending, None)
+                self.extracting = seq
+
+            start_time = time.time()
+            try:
+                result = self.extract_func(image)
+            except Exception:
+                result = {'ERROR': traceback.format_exc()}
+            finally:
+                release(frame_buffer)
+            result['SEQ'] = seq
+            result['QUEUE_DELAY'] = start_time - submit_time
+            result['EXTRACT_TIME'] = time.time() - start_time
+
+            # Publish the result replacing any result not yet fetched.
+            with self.condition:
+                self.result = result
+                self.extracting = None
+                self.completed += 1
+                self.condition.notify_all()
+
+
+def release(frame_buffer):
+    """ Releases the frame buffer if there is one.
+    """
+    if frame_buffer is not None:
+        frame_buffer.release()
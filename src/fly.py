@@ -27,6 +27,8 @@ import remote
 import tracking
 from tools import annotate
 from feature_extraction import feature_extractor
+from feature_extraction import batch
+from feature_extraction import windows
 from learning import dagger
 
 
@@ -39,10 +41,33 @@ class FlyTool(object):
     """
     HZ = 20
 
+    # Time in seconds the visual features of a frame may take before the
+    # lower priority extractors reuse their last features (None to always
+    # extract everything).
+    EXTRACTION_BUDGET = None
+
+    # Age in seconds past which frames are too stale to fly on and the next
+    # frame is waited for instead (None to fly on any frame).
+    MAX_FRAME_AGE = 0.25
+
+    # Number of processes the visual extractors are spread over (0 to
+    # extract them in the extraction thread). The processes are forked while
+    # the camera runs (see feature_extraction/parallel.py).
+    EXTRACTION_PROCESSES = 0
+
+    # Largest change in the predicted command allowed when pruning the
+    # features the model barely weighs when flying with it (None to extract
+    # every feature).
+    PRUNING_TOLERANCE = None
 
     def __init__(self, args):
         self.gui = args.gui
         self.verbosity = args.verbosity
+        self.flow_mode = args.flow
+        self.flow_tier = args.flow_tier
+        self.dtype = args.dtype
+        self.window_spec = windows.get_spec(args.windows)
+        self.structure = args.structure
 
         self.debug_queue = Queue.Queue()
         self.error_queue = Queue.Queue()
@@ -56,6 +81,8 @@ class FlyTool(object):
             self.test(args)
         elif args.command == 'exec':
             self.execute(args)
+        elif args.command == 'extract':
+            self.extract(args)
         elif args.command == 'annotate':
             self.annotate(args)
         elif args.command == 'run':
@@ -67,45 +94,53 @@ class FlyTool(object):
         self.learning = 'tikhonov'
         self.start_drone()
 
+        # Predict the commands as the feature blocks come in.
+        prediction = self.dag.get_streaming_prediction(self.feature_extractor.layout)
+        self.feature_extractor.set_prediction(prediction)
+
         # Loop until the drone has landed.
-        feature_flag = False
+        # The extractor releases the frame buffers it is handed.
+        frame = self.drone.get_frame(self.MAX_FRAME_AGE)
+        navdata = self.drone.get_navdata()
+        seq = self.feature_extractor.extract(frame['IMAGE'], frame['BUFFER'])
+        deadline = time.time()
         while True:
+            # Run at most HZ ticks a second.
+            deadline = self.wait_tick(deadline)
+
             # Land to avoid a crash.
             emergency_cmd = self.drone.get_cmd()
             if emergency_cmd is not None:
                 if emergency_cmd['L']:
                     self.drone.exit()
+                    self.feature_extractor.stop()
                     break
 
             expert_cmd = self.drone.get_cmd()
             expert_cmd['X'] = expert_cmd['X']#*0.15
 
-            if not feature_flag:
-                image = self.drone.get_image()
-                navdata = self.drone.get_navdata()
-                self.feature_extractor.extract(image)
-                feature_flag = True
-            try:
-                features = self.feature_queue.get(block=False)
-
-                # Get the command associated with this state.
-                blah = np.array([0])
-                blah.shape = (1, 1)
-                features_p = np.hstack((blah, features))
-                x = self.dag.test(features_p, self.iteration)
-                cmd = self.drone.default_cmd
-                cmd['Y'] = self.FORWARD_SPEED
-                cmd['X'] = x[0,0]#*0.15
-                #print(x)
-                self.feature_extractor.update(cmd, navdata)
-
+            # Wait until the end of the tick for the prediction from the
+            # features of the last frame.
+            result = prediction.get(seq, timeout=max(0.0, deadline - time.time()))
+            if result['ERROR'] is not None:
+                self.land_on_error(result['ERROR'])
+            if result['SEQ'] != seq or not result['BLOCKS']:
+                continue
+
+            # Get the command associated with this state, from the blocks
+            # extracted so far if the frame is late.
+            cmd = self.drone.default_cmd
+            cmd['Y'] = self.FORWARD_SPEED
+            cmd['X'] = result['PREDICTION']#*0.15
+            self.drone.send_cmd(cmd)
 
-                self.drone.send_cmd(cmd)
-                feature_flag = False
-            except Queue.Empty:
-                pass
+            if result['FINAL']:
+                self.feature_extractor.update(cmd, navdata)
 
-            time.sleep(1.0/self.HZ)        
+                # Start extracting the next frame.
+                frame = self.drone.get_frame(self.MAX_FRAME_AGE)
+                navdata = self.drone.get_navdata()
+                seq = self.feature_extractor.extract(frame['IMAGE'], frame['BUFFER'])
 
 
     def train(self, args):
@@ -115,7 +150,7 @@ class FlyTool(object):
         self.learning = args.learning
 
         # Create the dagger object.
-        self.dag = dagger.DAgger(self.learning)
+        self.dag = dagger.DAgger(self.learning, self.dtype)
         self.dag.aggregate(self.iterations)
 
 
@@ -130,12 +165,12 @@ class FlyTool(object):
         # Create the dagger object and train it.
         #pdb.set_trace()
         if(self.iteration > 1):
-            self.dag = dagger.DAgger(self.learning)
+            self.dag = dagger.DAgger(self.learning, self.dtype)
             self.dag.train()
 
         # Feature extraction parameters.
-        window_size = (10, 5)
-        overlap = 0.25
+        window_size = self.window_spec  # the windows of the visual features
+        overlap = self.window_spec.overlap
         cmd_history_feats = 7    # the approximate number of cmd history features
         cmd_history_length = 10  # keep a running list of the last 10 cmds
         nav_history_feats = 7    # the approximate number of nav history features
@@ -153,18 +188,25 @@ class FlyTool(object):
         self.debugger.debug()
         self.drone = parrot.Parrot()
 
-        self.feature_queue = Queue.Queue(maxsize=1)
         init_image = self.drone.get_image()
-        self.feature_extractor = feature_extractor.FeatureExtractor(self.feature_queue,
-                                                                    init_image,
+        self.feature_extractor = feature_extractor.FeatureExtractor(init_image,
                                                                     window_size,
                                                                     overlap,
                                                                     cmd_history_feats,
                                                                     cmd_history_length,
                                                                     nav_history_feats,
-                                                                    nav_history_length)
+                                                                    nav_history_length,
+                                                                    flow_mode=self.flow_mode,
+                                                                    flow_tier=self.flow_tier,
+                                                                    structure=self.structure,
+                                                                    processes=self.EXTRACTION_PROCESSES,
+                                                                    budget=self.EXTRACTION_BUDGET,
+                                                                    dtype=self.dtype)
+        if self.iteration > 1:
+            self.dag.check_layout(self.feature_extractor.layout)
 
         directory = '../data/%s/%s/' % (self.iteration, self.trajectory)
+        self.feature_extractor.layout.save(directory + 'features.layout')
 
         # Start training.
         if self.iteration == 1:
@@ -192,13 +234,18 @@ class FlyTool(object):
 
         # Loop until the drone has landed.
         self.time_step = 1
-        feature_flag = False
+        seq = None
+        deadline = time.time()
         while True:
+            # Run at most HZ ticks a second.
+            deadline = self.wait_tick(deadline)
+
             # Land to avoid a crash.
             emergency_cmd = self.drone.get_cmd()
             if emergency_cmd is not None:
                 if emergency_cmd['L']:
                     self.drone.exit()
+                    self.feature_extractor.stop()
                     break
 
             image_filename = directory + '%s.jpg' % self.time_step
@@ -207,34 +254,48 @@ class FlyTool(object):
             expert_cmd['X'] = expert_cmd['X']#*0.15
             if self.iteration == 1:
                 expert_cmd['Y'] = self.FORWARD_SPEED
-                if expert_cmd is not None and not feature_flag:
-                    image = self.drone.get_image()
+                if seq is None:
+                    # Both the extractor and the recorder hold the frame.
+                    frame = self.drone.get_frame(self.MAX_FRAME_AGE)
+                    image = frame['IMAGE']
                     navdata = self.drone.get_navdata()
-                    self.feature_extractor.extract(image)
-                    self.feature_extractor.update(cmd, navdata)
-                    feature_flag = True
-                try:
-                    features = self.feature_queue.get(block=False)
+                    seq = self.feature_extractor.extract(image, frame['BUFFER'].retain())
+
+                # Wait until the end of the tick for the features of the last
+                # frame.
+                result = self.feature_extractor.get_result(seq, timeout=max(0.0, deadline - time.time()))
+                if result is not None and 'ERROR' in result:
+                    self.land_on_error(result['ERROR'])
+                if result is not None:
+                    # The history of the next frame includes this command.
+                    self.feature_extractor.update(expert_cmd, navdata)
+
                     # Save the features and command.
                     self.save_image(image, image_filename)
-                    self.save_features(features, features_filename)
+                    frame['BUFFER'].release()
+                    self.save_features(result['FEATURES'], features_filename)
                     self.save_cmd(expert_cmd, cmd_filename)
                     self.time_step += 1
-                    feature_flag = False
-                except Queue.Empty:
-                    pass
+                    seq = None
                 self.drone.send_cmd(expert_cmd)
             else:
-                if not feature_flag:
-                    image = self.drone.get_image()
+                if seq is None:
+                    # Both the extractor and the recorder hold the frame.
+                    frame = self.drone.get_frame(self.MAX_FRAME_AGE)
+                    image = frame['IMAGE']
                     navdata = self.drone.get_navdata()
-                    self.feature_extractor.extract(image)
-                    feature_flag = True
-                try:
-                    features = self.feature_queue.get(block=False)
+                    seq = self.feature_extractor.extract(image, frame['BUFFER'].retain())
+
+                # Wait until the end of the tick for the features of the last
+                # frame.
+                result = self.feature_extractor.get_result(seq, timeout=max(0.0, deadline - time.time()))
+                if result is not None and 'ERROR' in result:
+                    self.land_on_error(result['ERROR'])
+                if result is not None:
+                    features = result['FEATURES']
 
                     # Get the command associated with this state.
-                    blah = np.array([0])
+                    blah = np.array([0], dtype=features.dtype)
                     blah.shape = (1, 1)
                     features_p = np.hstack((blah, features))
                     x = self.dag.test(features_p, self.iteration)
@@ -246,20 +307,75 @@ class FlyTool(object):
 
                     # Save the features and command.
                     self.save_image(image, image_filename)
+                    frame['BUFFER'].release()
                     self.save_features(features, features_filename)
                     self.save_cmd(cmd, cmd_filename)
                     self.time_step += 1
 
                     self.drone.send_cmd(cmd)
-                    feature_flag = False
-                except Queue.Empty:
-                    pass
-
-            time.sleep(1.0/self.HZ)
+                    seq = None
                 
+    def wait_tick(self, deadline):
+        """ Sleeps until the given deadline and returns the deadline of the
+            next tick, 1/HZ seconds after it (or after now if running late).
+        """
+        now = time.time()
+        if deadline > now:
+            time.sleep(deadline - now)
+            now = deadline
+        return now + 1.0/self.HZ
+
+    def land_on_error(self, error):
+        """ Lands the drone when the features of a frame failed to extract.
+        """
+        self.drone.exit()
+        self.feature_extractor.stop()
+        raise debug.Error('fly', 'feature extraction failed, landing\n%s' % error)
+
     def test(self, args):
         pass
 
+    def extract(self, args):
+        """ Extracts the features of every recorded trajectory of the given
+            iterations from their saved frames.
+        """
+        # Feature extraction parameters.
+        params = {
+            'window_size': self.window_spec.config(),
+            'overlap': self.window_spec.overlap,
+            'cmd_history_feats': 7,     # the approximate number of cmd history features
+            'cmd_history_length': 10,   # keep a running list of the last 10 cmds
+            'nav_history_feats': 7,     # the approximate number of nav history features
+            'nav_history_length': 10,   # keep a running list of the last 10 nav data
+            'flow_mode': self.flow_mode,
+            'flow_tier': self.flow_tier,
+            'structure': self.structure,
+            'dtype': self.dtype
+        }
+        cache_directory = None if args.no_cache else args.cache
+
+        self.debug_queue.put({'MSG': 'Parrot AR 2 Flying Tool :: Extraction Mode', 'PRIORITY': 1})
+        self.debug_queue.put({'MSG': ':: Verbosity set to %d.' % self.verbosity, 'PRIORITY': 1})
+        self.debug_queue.put({'MSG': ':: Extracting iterations 1 to %s.' % args.iterations, 'PRIORITY': 1})
+        self.debug_queue.put({'MSG': ':: Feature cache set to %s.' % cache_directory, 'PRIORITY': 1})
+        self.debug_queue.put({'MSG': ':: Flow mode set to %s (tier %s).' % (self.flow_mode, self.flow_tier), 'PRIORITY': 1})
+        self.debug_queue.put({'MSG': ':: Features saved as %s.' % self.dtype, 'PRIORITY': 1})
+        self.debug_queue.put({'MSG': ':: Extracting %s windows (%s).' % (self.window_spec.size, args.windows), 'PRIORITY': 1})
+        self.debug_queue.put({'MSG': ':: Structure features set to %s.' % self.structure, 'PRIORITY': 1})
+        self.debugger.debug()
+
+        def report(directory, frames, error):
+            if error is None:
+                self.debug_queue.put({'MSG': 'Extracted %s frames of %s.' % (frames, directory), 'PRIORITY': 1})
+            else:
+                self.debug_queue.put({'MSG': 'Failed to extract %s:\n%s' % (directory, error), 'PRIORITY': 1})
+            self.debugger.debug()
+
+        extractor = batch.BatchExtractor('../data', args.iterations, params, args.processes, cache_directory)
+        failed = extractor.run(report)
+        if failed:
+            raise debug.Error('extract', 'failed to extract %s trajectories' % len(failed))
+
     def annotate(self, args):
         self.iteration = args.iteration
         self.trajectory = args.trajectory
@@ -308,7 +424,7 @@ class FlyTool(object):
         # Create the dagger object and train it.
         #pdb.set_trace()
         if(self.iteration > 1):
-            self.dag = dagger.DAgger(self.learning)
+            self.dag = dagger.DAgger(self.learning, self.dtype)
 
             if(os.path.isfile('../data/coef.txt')):
                 print('Load training')
@@ -319,8 +435,8 @@ class FlyTool(object):
                 self.dag.save_coef()
 
         # Feature extraction parameters.
-        window_size = (10, 5)
-        overlap = 0.25
+        window_size = self.window_spec  # the windows of the visual features
+        overlap = self.window_spec.overlap
         cmd_history_feats = 7    # the approximate number of cmd history features
         cmd_history_length = 10  # keep a running list of the last 10 cmds
         nav_history_feats = 7    # the approximate number of nav history features
@@ -331,16 +447,30 @@ class FlyTool(object):
         self.debugger.debug()
         self.drone = parrot.Parrot()
 
-        self.feature_queue = Queue.Queue(maxsize=1)
+        # Only extract the features the model weighs.
+        pruning = None
+        if self.iteration > 1 and self.PRUNING_TOLERANCE is not None:
+            pruning = self.dag.get_pruning_plan(self.PRUNING_TOLERANCE)
+            self.debug_queue.put({'MSG': ':: Keeping %.0f%% of the visual feature cells, predictions within %s.' % (100*pruning.get_fraction(), pruning.bound), 'PRIORITY': 1})
+            self.debugger.debug()
+
         init_image = self.drone.get_image()
-        self.feature_extractor = feature_extractor.FeatureExtractor(self.feature_queue,
-                                                                    init_image,
+        self.feature_extractor = feature_extractor.FeatureExtractor(init_image,
                                                                     window_size,
                                                                     overlap,
                                                                     cmd_history_feats,
                                                                     cmd_history_length,
                                                                     nav_history_feats,
-                                                                    nav_history_length)
+                                                                    nav_history_length,
+                                                                    flow_mode=self.flow_mode,
+                                                                    flow_tier=self.flow_tier,
+                                                                    structure=self.structure,
+                                                                    processes=self.EXTRACTION_PROCESSES,
+                                                                    budget=self.EXTRACTION_BUDGET,
+                                                                    dtype=self.dtype,
+                                                                    pruning=pruning)
+        if self.iteration > 1:
+            self.dag.check_layout(self.feature_extractor.layout)
 
 
     def create_annotate_gui(self):
@@ -407,7 +537,7 @@ class FlyTool(object):
         self.debugger.debug()
         with open(filename, 'a') as out:
             line = np.hstack(([[self.time_step]], features))
-            np.savetxt(out, line)
+            np.savetxt(out, line, fmt=self.feature_extractor.layout.get_format())
 
     def save_image(self, image, filename):
         self.debug_queue.put({'MSG': "Saving image for time-step %s to file: %s." % (self.time_step, filename), 'PRIORITY': 1})
@@ -4,15 +4,28 @@
 """
 
 import json
+import os.path
+import threading
+import time
 import numpy as np
-from sklearn.linear_model import Ridge
+from sklearn.linear_model import Lasso, Ridge
+
+from feature_extraction.layout import FeatureLayout
+from feature_extraction.pruning import PruningPlan
 
 
 class DAgger(object):
     """ DAgger algorithm.
+
+        Features are parsed and commands predicted in the given dtype. The
+        model is always fitted in float64 while its weights are cast to the
+        dtype for predicting, so in float32 a prediction reads the features
+        at half the memory traffic and differs from the float64 one by about
+        the float32 rounding of each feature.
     """
-    def __init__(self, learner):
+    def __init__(self, learner, dtype='float64'):
         self.learner = learner
+        self.dtype = np.dtype(dtype)
 
         # The level of alpha to use for learning ridge regression. Affects the
         # size of the weights and finds a point on the pareto optimal tradeoff
@@ -23,6 +36,14 @@ class DAgger(object):
         self.aggregate_features_filename = '../data/aggregate_features.data'
         self.aggregate_cmds_filename = '../data/aggregate_cmds.data'
 
+        # The layout of the feature columns following the time step column of
+        # the features (see feature_extraction/layout.py). It is saved next to
+        # the features and the coefficients so they can be checked against
+        # the layout of the feature extractor.
+        self.aggregate_layout_filename = '../data/aggregate_features.layout'
+        self.coef_layout_filename = '../data/coef.layout'
+        self.layout = None
+
         # Load the features into numpy.
         try:
             self.features = self.load_features(self.aggregate_features_filename)
@@ -47,20 +68,44 @@ class DAgger(object):
             while True:
                 features_filename = current_directory + '%s/features.data' % cur_trajectory
                 cmds_filename = current_directory + '%s/expert_cmds.data' % cur_trajectory
+                layout_filename = current_directory + '%s/features.layout' % cur_trajectory
                 try:
                     cur_features = self.load_features(features_filename)
                     cur_cmds = self.load_cmds(cmds_filename)
-                    self.features += cur_features
-                    self.cmds += cur_cmds
-                    cur_trajectory += 1
                 except:
                     break
+                self.aggregate_layout(layout_filename)
+                self.features += cur_features
+                self.cmds += cur_cmds
+                cur_trajectory += 1
 
         # Write the data to the aggregate file.
         with open(self.aggregate_features_filename, 'w') as f:
             f.write(self.features) 
         with open(self.aggregate_cmds_filename, 'w') as f:
             f.write(self.cmds)
+        if self.layout is not None:
+            self.layout.save(self.aggregate_layout_filename)
+
+    def aggregate_layout(self, filename):
+        """ Makes sure the layout of a trajectory's features, if it was saved,
+            matches that of the trajectories aggregated before it.
+        """
+        if not os.path.isfile(filename):
+            return
+        layout = FeatureLayout.load(filename)
+        if self.layout is None:
+            self.layout = layout
+        else:
+            self.layout.check(layout)
+
+    def check_layout(self, layout):
+        """ Makes sure the features the model was trained on have the same
+            layout as the given one. Models trained before layouts were saved
+            are not checked.
+        """
+        if self.layout is not None:
+            self.layout.check(layout)
 
     def load_features(self, filename):
         with open(filename, 'r') as f:
@@ -73,7 +118,7 @@ class DAgger(object):
         features_str = [i for i in features_str if i != '']
         for i in range(0, len(features_str)):
             cur_features_str = features_str[i].split(' ')
-            cur_features_np = np.loadtxt(cur_features_str)
+            cur_features_np = np.loadtxt(cur_features_str, dtype=self.dtype)
             features_np = np.vstack((features_np, cur_features_np)) if features_np is not None else cur_features_np
         return features_np
 
@@ -101,24 +146,68 @@ class DAgger(object):
     def get_current_trajectory(self):
         return self.j
 
-    def train(self):
+    def train(self, sparsity=None):
         """ Trains the ridge regressor on the aggregate of the data.
+
+            Given a sparsity, a lasso regressor with that penalty is trained
+            instead, which zeroes the weights of more features so more of them
+            can be pruned (see get_pruning_plan).
         """
         # Load the aggregate data.
         aggregate_features_str = self.load_features(self.aggregate_features_filename)
         aggregate_cmds_str = self.load_cmds(self.aggregate_cmds_filename)
         aggregate_features = self.parse_features(aggregate_features_str)
         aggregate_cmds = self.parse_cmds(aggregate_cmds_str)
+        fit_features = np.asarray(aggregate_features, dtype=np.float64)
 
-        self.ridge = Ridge(alpha=self.alpha)
-        self.ridge.fit(aggregate_features, aggregate_cmds)
+        if sparsity is None:
+            self.ridge = Ridge(alpha=self.alpha)
+            self.ridge.fit(fit_features, aggregate_cmds)
+        else:
+            # Keep the weights in the same shape as those of the ridge.
+            self.ridge = Lasso(alpha=sparsity)
+            self.ridge.fit(fit_features, aggregate_cmds[:, 0])
+            self.ridge.coef_ = np.reshape(self.ridge.coef_, (1, -1))
+            self.ridge.intercept_ = np.reshape(self.ridge.intercept_, (1,))
+        self.train_features = aggregate_features
+        self.init_weights()
+        if os.path.isfile(self.aggregate_layout_filename):
+            self.layout = FeatureLayout.load(self.aggregate_layout_filename)
+
+    def get_pruning_plan(self, tolerance):
+        """ Builds the plan of the features worth extracting for the trained
+            model, whose predictions on the training data change by at most
+            tolerance (see feature_extraction/pruning.py). The first column
+            of the features is the time step, which the model is not given.
+        """
+        if self.layout is None:
+            raise ValueError('the model has no feature layout to prune')
+        features = getattr(self, 'train_features', None)
+        if features is None:
+            features = self.parse_features(self.load_features(self.aggregate_features_filename))
+        return PruningPlan.build(self.layout, self.ridge.coef_[:, 1:], features[:, 1:], tolerance)
+
+    def init_weights(self):
+        """ Casts the weights of the model to the dtype of the predictions.
+        """
+        self.coef = np.asarray(self.ridge.coef_, dtype=self.dtype).T.copy()
+        self.intercept = np.asarray(self.ridge.intercept_, dtype=self.dtype)
 
     def test(self, x, iteration):
         """ Try to fit the new state to a left/right control input.
-        """ 
-        x_value = self.ridge.predict(x)
+        """
+        x = np.asarray(x, dtype=self.dtype)
+        x_value = np.dot(x, self.coef) + self.intercept
         return x_value
 
+    def get_streaming_prediction(self, layout):
+        """ Returns a streaming prediction of the model for features of the
+            given layout (see StreamingPrediction).
+        """
+        self.check_layout(layout)
+        # The first weight is that of the time step column.
+        return StreamingPrediction(self.coef[1:, 0], float(np.ravel(self.intercept)[0]), layout)
+
     def save_coef(self):
         with open('../data/coef.txt', 'w') as out:
             coef = np.array(self.ridge.coef_)
@@ -128,6 +217,9 @@ class DAgger(object):
             intercept = np.array(self.ridge.intercept_)
             np.savetxt(out, intercept)
 
+        if self.layout is not None:
+            self.layout.save(self.coef_layout_filename)
+
     def load_coef(self):
         coef = np.loadtxt('../data/coef.txt', ndmin=2)
         intercept = np.loadtxt('../data/intercept.txt')
@@ -135,9 +227,104 @@ class DAgger(object):
         self.ridge = Ridge(alpha=self.alpha)
         self.ridge.coef_ = coef
         self.ridge.intercept_ = intercept
+        self.init_weights()
+        if os.path.isfile(self.coef_layout_filename):
+            self.layout = FeatureLayout.load(self.coef_layout_filename)
         
 
 
+class StreamingPrediction(object):
+    """ Prediction of a linear model accumulated block by block.
+
+        The prediction is the intercept plus the dot product of every block
+        of the feature row (see feature_extraction/layout.py) with its
+        weights, so it can be summed up as the blocks are extracted. The
+        blocks of a frame not extracted yet count with their contribution
+        from the frame before, like the blocks skipped to stay within budget,
+        so the running prediction is a full prediction from the freshest
+        features at hand.
+
+        The extraction thread starts each frame with start, adds its blocks
+        with add and marks it final with finish, or with fail if extracting
+        it raised, while the control loop fetches the running prediction
+        with get.
+    """
+    def __init__(self, weights, intercept, layout):
+        self.layout = layout
+        self.intercept = intercept
+        self.weights = dict((b['NAME'], weights[layout.slices[b['NAME']]]) for b in layout.blocks)
+        self.contributions = dict((b['NAME'], 0.0) for b in layout.blocks)
+
+        self.condition = threading.Condition()
+        self.seq = None
+        self.blocks = []
+        self.final = False
+        self.error = None
+        self.value = intercept
+
+    def reset(self, feats):
+        """ Sets the contribution of every block from a feature row.
+        """
+        for name in self.contributions:
+            self.add(name, feats)
+        with self.condition:
+            self.blocks = []
+
+    def start(self, seq):
+        """ Starts the prediction of the frame with the given sequence
+            number.
+        """
+        with self.condition:
+            self.seq = seq
+            self.blocks = []
+            self.final = False
+            self.error = None
+            self.condition.notify_all()
+
+    def add(self, name, feats):
+        """ Adds the block of the feature row to the prediction.
+        """
+        contribution = float(np.dot(feats[0, self.layout.slices[name]], self.weights[name]))
+        with self.condition:
+            self.contributions[name] = contribution
+            self.value = self.intercept + sum(self.contributions.values())
+            self.blocks.append(name)
+            self.condition.notify_all()
+
+    def finish(self):
+        """ Marks the prediction of the frame as final.
+        """
+        with self.condition:
+            self.final = True
+            self.condition.notify_all()
+
+    def fail(self, error):
+        """ Marks the prediction of the frame as final after extracting it
+            failed with the given error.
+        """
+        with self.condition:
+            self.final = True
+            self.error = error
+            self.condition.notify_all()
+
+    def get(self, seq=None, timeout=None):
+        """ Returns the running prediction (PREDICTION), whether it is final
+            (FINAL), the sequence number of its frame (SEQ), the blocks of
+            that frame added so far (BLOCKS) and the error extracting it
+            failed with if it did (ERROR), waiting at most timeout seconds
+            (forever if timeout is None) for the final prediction of frame
+            seq, or of the current frame if seq is None.
+        """
+        with self.condition:
+            deadline = None if timeout is None else time.time() + timeout
+            while not (self.final and (seq is None or self.seq >= seq)):
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            return {'PREDICTION': self.value, 'FINAL': self.final, 'SEQ': self.seq, 'BLOCKS': list(self.blocks), 'ERROR': self.error}
+
+
 def _test_dagger():
     pdb.set_trace()
     iteration = 1
@@ -150,6 +337,89 @@ def _test_dagger():
     
     d.train()
 
+
+def _test_float32_inference():
+    # Make sure float32 features and predictions stay close to the float64
+    # ones on the features of a real video.
+    import cv2
+    from feature_extraction import feature_extractor
+    params = ((10, 5), 0.25, 7, 10, 7, 10)
+    stream = cv2.VideoCapture('../samples/test_cat.mp4')
+    (_, init_image) = stream.read()
+    fe64 = feature_extractor.FeatureExtractor(init_image, *params)
+    fe32 = feature_extractor.FeatureExtractor(init_image, *params, dtype='float32')
+    try:
+        features64 = []
+        features32 = []
+        for i in range(0, 20):
+            (_, image) = stream.read()
+            cmd = {'X': np.sin(i), 'Y': 0.4, 'Z': 0.0, 'R': 0.0}
+            for (fe, features) in ((fe64, features64), (fe32, features32)):
+                features.append(np.hstack(([[i]], fe.get_features(image))).astype(fe.dtype))
+                fe.extractor_cmd_history.update(cmd)
+    finally:
+        fe64.stop()
+        fe32.stop()
+    features64 = np.vstack(features64)
+    features32 = np.vstack(features32)
+    assert features32.dtype == np.float32
+    assert np.allclose(features32, features64, rtol=1e-5, atol=1e-5)
+
+    d64 = DAgger('tikhonov')
+    d32 = DAgger('tikhonov', 'float32')
+    d64.ridge = Ridge(alpha=d64.alpha).fit(features64, np.random.randn(features64.shape[0], 1))
+    d32.ridge = d64.ridge
+    d64.init_weights()
+    d32.init_weights()
+    x64 = d64.test(features64, 1)
+    x32 = d32.test(features32, 1)
+    assert x32.dtype == np.float32 and x32.shape == x64.shape
+
+    # Bound the difference by the rounding error of a float32 dot product
+    # on top of that of the features.
+    magnitude = np.dot(np.abs(features64), np.abs(d64.coef)) + np.abs(d64.intercept)
+    bound = (features64.shape[1] + 2)*np.finfo(np.float32).eps*magnitude + 1e-5*np.abs(d64.coef).sum()
+    assert np.all(np.abs(x32 - x64) <= bound)
+    print('Success.')
+
+
+def _test_streaming_prediction():
+    # Make sure the streamed prediction adds up to the full one.
+    layout = FeatureLayout()
+    layout.add_block('flow', ['MIN', 'MAX'], 10)
+    layout.add_block('cmd_history', ['X', 'Y'], 3)
+    d = DAgger('tikhonov')
+    d.ridge = Ridge(alpha=d.alpha)
+    d.ridge.coef_ = np.random.randn(1, layout.size + 1)
+    d.ridge.intercept_ = np.array([0.5])
+    d.init_weights()
+    prediction = d.get_streaming_prediction(layout)
+    prediction.reset(layout.get_buffer())
+    assert prediction.get(timeout=0)['PREDICTION'] == 0.5
+
+    feats = np.random.randn(1, layout.size)
+    expected = d.test(np.hstack(([[0]], feats)), 1)[0, 0]
+    prediction.start(1)
+    prediction.add('cmd_history', feats)
+    result = prediction.get(1, timeout=0.01)
+    assert not result['FINAL'] and result['BLOCKS'] == ['cmd_history']
+    prediction.add('flow', feats)
+    prediction.finish()
+    result = prediction.get(1, timeout=0.01)
+    assert result['FINAL'] and np.isclose(result['PREDICTION'], expected)
+
+    # The blocks of the next frame start from those of the last one.
+    prediction.start(2)
+    feats[0, layout.slices['cmd_history']] = 0
+    prediction.add('cmd_history', feats)
+    result = prediction.get(2, timeout=0.01)
+    assert not result['FINAL'] and result['SEQ'] == 2
+    assert np.isclose(result['PREDICTION'], 0.5 + np.dot(feats[0], d.coef[1:, 0]))
+    print('Success.')
+
+
 if __name__ == '__main__':
     import pdb
-    _test_dagger()
+    #_test_dagger()
+    _test_float32_inference()
+    _test_streaming_prediction()
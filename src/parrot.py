@@ -7,7 +7,6 @@
 
 import cv2
 import json
-import Queue
 import numpy as np
 
 # Local modules.
@@ -75,8 +74,12 @@ class Parrot(object):
         self.receiver = receiver.Receiver(self.debug_queue, self.error_queue)
 
         camera_address = 'tcp://' + self.drone_address + ':' + str(self.ports['VIDEO'])
-        self.image_queue = Queue.Queue(maxsize=1)
-        self.camera = camera.Camera(self.debug_queue, self.error_queue, camera_address, self.image_queue)
+        self.image_mailbox = camera.FrameMailbox()
+        self.image_age = None
+        self.frame_pool = camera.FramePool()
+        # Only decode the frames that are read (see camera.Camera).
+        self.capture_mode = 'grab'
+        self.camera = camera.Camera(self.debug_queue, self.error_queue, camera_address, self.image_mailbox, self.frame_pool, self.capture_mode)
         self.camera.daemon = True
         self.camera.start()
 
@@ -84,9 +87,24 @@ class Parrot(object):
         navdata = self.receiver.get_navdata()
         return navdata
 
-    def get_image(self):
-        image = self.image_queue.get(block=True)
-        return image
+    def get_frame(self, max_age=None):
+        """ Waits for the newest frame from the front camera no older than
+            max_age seconds and returns it along with its sequence number,
+            capture time, age and frame buffer (see camera.FrameMailbox.get).
+            The caller releases the frame buffer when done with the image.
+        """
+        return self.image_mailbox.get(block=True, max_age=max_age)
+
+    def get_image(self, max_age=None):
+        """ Waits for the newest image from the front camera, rejecting
+            images older than max_age seconds. The age of the image is kept
+            in image_age. The image is taken out of the frame pool, so it can
+            be kept for long but costs a new buffer. Use get_frame in loops.
+        """
+        frame = self.get_frame(max_age)
+        self.image_age = frame['AGE']
+        frame['BUFFER'].detach()
+        return frame['IMAGE']
 
     def get_cmd(self):
         cmd = self.remote.get_input()
@@ -7,7 +7,6 @@
 
 import cv2
 import json
-import Queue
 import numpy as np
 
 # Local modules.
@@ -16,6 +15,7 @@ import simCamera as camera
 import simController as controller
 import debug
 import simReceiver as receiver
+from camera import FrameMailbox, monotonic
 
 # Tracking modules.
 from tracking import bounding_box
@@ -41,6 +41,10 @@ class Parrot(object):
         self.latest_nav = None
         self.latest_cmd = None
 
+        # The newest frame, created before subscribing to the camera.
+        self.image_mailbox = FrameMailbox()
+        self.image_age = None
+
         # The default command that is sent to the drone.
         self.default_cmd = {
             'X': 0.0,
@@ -63,14 +67,27 @@ class Parrot(object):
 
         print('SimParrot connected')
 
-        self.image_queue = Queue.Queue(maxsize=1)
-
     def get_navdata(self):
         return self.latest_nav
 
-    def get_image(self):
-        image = self.image_queue.get(block=True)
-        return image
+    def get_frame(self, max_age=None):
+        """ Waits for the newest frame from the simulator no older than
+            max_age seconds and returns it along with its sequence number,
+            capture time, age and frame buffer (see camera.FrameMailbox.get).
+            The caller releases the frame buffer when done with the image.
+        """
+        return self.image_mailbox.get(block=True, max_age=max_age)
+
+    def get_image(self, max_age=None):
+        """ Waits for the newest image from the simulator, rejecting images
+            older than max_age seconds. The age of the image is kept in
+            image_age. The image is taken out of the frame pool, so it can be
+            kept for long but costs a new buffer. Use get_frame in loops.
+        """
+        frame = self.get_frame(max_age)
+        self.image_age = frame['AGE']
+        frame['BUFFER'].detach()
+        return frame['IMAGE']
 
     def get_cmd(self):
         return self.latest_cmd
@@ -106,13 +123,14 @@ class Parrot(object):
 
     def on_frame(self, data):
         #print("Frame")
-        array = np.fromstring(data.getBytes(), dtype='uint8')
+        timestamp = monotonic()
+        # Wrap the message bytes without copying them. OpenCV cannot decode
+        # into a given buffer from Python, so frames are not pooled here.
+        array = np.frombuffer(data.getBytes(), dtype='uint8')
         img = cv2.imdecode(array, 1)
 
         try:
-            self.image_queue.put(img, block=False)
-        except Queue.Full:
-            pass
+            self.image_mailbox.put(img, timestamp)
         except Exception as ex:
             print(ex)
 